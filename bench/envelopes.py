@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the cost of constructing envelopes for a large number of documents,
+and the memory taken to hold all of them at once.
+
+Usage: bench/envelopes.py [document count]
+"""
+
+import sys
+import time
+import tracemalloc
+from os import path
+from types import SimpleNamespace
+
+sys.path.append(path.join(path.dirname(__file__), '..'))
+
+from deconstrst.config import Configuration
+from deconstrst.builders.envelope import Envelope, EnvelopeContext
+
+DEFAULT_COUNT = 10000
+
+
+class Visitor:
+    def calculate_offsets(self):
+        return {}
+
+
+def main(count):
+    deconst_config = Configuration({'CONTENT_ID_BASE': 'https://github.com/bench/envelopes/'})
+    deconst_config.meta = {'someKey': 'some value', 'other': ['a', 'b', 'c']}
+    deconst_config.github_url = 'https://github.com/bench/envelopes/'
+    deconst_config.git_root = path.dirname(path.abspath(__file__))
+
+    config = SimpleNamespace(source_suffix=['.rst'],
+                             deconst_default_layout='default',
+                             deconst_default_unsearchable=None,
+                             deconst_categories=['global category', 'common category'])
+    docwriter = SimpleNamespace(visitor=Visitor())
+    per_page_meta = {'deconstcategories': 'one, two,three , four'}
+
+    def construct(i):
+        return Envelope(docname='section{}/page{}'.format(i % 100, i),
+                        body='<p>Body</p>',
+                        title='Page {}'.format(i),
+                        toc=None,
+                        context=context,
+                        per_page_meta=per_page_meta,
+                        docwriter=docwriter)
+
+    start = time.perf_counter()
+
+    context = EnvelopeContext(config, deconst_config)
+    for i in range(count):
+        construct(i).serialization_payload()
+
+    elapsed = time.perf_counter() - start
+    print('{} envelopes in {:.3f}s ({:.2f}us each)'.format(count, elapsed, elapsed / count * 1e6))
+
+    tracemalloc.start()
+    retained = [construct(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{} envelopes held in {:.1f}KiB ({} bytes each)'.format(
+        len(retained), size / 1024, size // len(retained)))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Build synthetic Sphinx repositories with each deconst builder and record how
+long each build takes, how that time is divided between build phases (as
+reported by TIMING_REPORT), and its peak memory use.
+
+Usage: bench/suite.py [options]
+
+Results are written as JSON. Pass the results of an earlier run with
+--compare to report builds that have become slower or larger since then.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from os import path
+
+ROOT = path.realpath(path.join(path.dirname(__file__), '..'))
+
+BUILDERS = ['deconst-serial', 'deconst-single']
+
+LOREM = ('Enim qui sit velit sunt non duis sint in ea. Minim ex do ex excepteur ea '
+         'sunt anim. Laboris commodo esse eiusmod adipisicing laboris voluptate '
+         'commodo quis. Ut consequat aute aliquip sint amet exercitation aliquip '
+         'do Lorem nisi sint dolor anim occaecat.')
+
+CONF = '''# -*- coding: utf-8 -*-
+# Generated by bench/suite.py.
+
+extensions = []
+templates_path = []
+source_suffix = '.rst'
+master_doc = 'index'
+project = 'Synthetic Corpus'
+copyright = '2016, Bench'
+author = 'Bench'
+version = '1.0'
+release = '1.0'
+language = None
+exclude_patterns = ['_build']
+pygments_style = 'sphinx'
+html_theme = 'alabaster'
+
+builder = {builder!r}
+'''
+
+
+def png(index):
+    """
+    Generate a small, valid PNG whose color depends on "index".
+    """
+
+    width = height = 16
+    pixel = bytes([index * 37 % 256, index * 71 % 256, index * 113 % 256])
+    raw = b''.join(b'\x00' + pixel * width for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw)),
+        chunk(b'IEND', b''),
+    ])
+
+
+class Corpus:
+    """
+    The parameters of a synthetic Sphinx repository.
+    """
+
+    def __init__(self, pages, depth, breadth, images, distinct_images, code_blocks, paragraphs):
+        self.pages = pages
+        self.depth = depth
+        self.breadth = breadth
+        self.images = images
+        self.distinct_images = distinct_images
+        self.code_blocks = code_blocks
+        self.paragraphs = paragraphs
+
+    def describe(self):
+        return {
+            'pages': self.pages,
+            'depth': self.depth,
+            'breadth': self.breadth,
+            'images': self.images,
+            'distinct_images': self.distinct_images,
+            'code_blocks': self.code_blocks,
+            'paragraphs': self.paragraphs,
+        }
+
+    def toctree(self):
+        """
+        Arrange the pages beneath the index in a tree no more than "depth"
+        levels deep, with up to "breadth" children per page. Pages that don't
+        fit are listed by the index directly. Return a map from each document
+        to its children.
+        """
+
+        docnames = ['page{:05d}'.format(i) for i in range(self.pages)]
+        children = {'index': []}
+
+        remaining = iter(docnames)
+        level = ['index']
+        for _ in range(self.depth):
+            next_level = []
+            for parent in level:
+                for docname in remaining:
+                    children[parent].append(docname)
+                    children[docname] = []
+                    next_level.append(docname)
+                    if len(children[parent]) == self.breadth:
+                        break
+            level = next_level
+
+        for docname in remaining:
+            children['index'].append(docname)
+            children[docname] = []
+
+        return children
+
+    def generate(self, root):
+        """
+        Write the repository's source files beneath "root".
+        """
+
+        os.makedirs(path.join(root, '_images', 'bench'))
+        for i in range(self.distinct_images):
+            with open(path.join(root, '_images', 'bench', 'image{}.png'.format(i)), 'wb') as f:
+                f.write(png(i))
+
+        with open(path.join(root, '_deconst.json'), 'w', encoding='utf-8') as f:
+            json.dump({'contentIDBase': 'https://github.com/bench/synthetic'}, f)
+
+        image = 0
+        for docname, kids in sorted(self.toctree().items()):
+            lines = []
+            title = 'Index' if docname == 'index' else 'Page {}'.format(docname[4:])
+            lines += [title, '=' * len(title), '']
+
+            for p in range(self.paragraphs):
+                lines += ['{} *{}* {}'.format(LOREM, docname, p), '']
+
+            for _ in range(self.images):
+                if self.distinct_images:
+                    lines += ['.. image:: _images/bench/image{}.png'.format(image % self.distinct_images), '']
+                    image += 1
+
+            for c in range(self.code_blocks):
+                lines += ['Section {}'.format(c), '-' * len('Section {}'.format(c)), '',
+                          '.. code-block:: python', '',
+                          '   def example_{}():'.format(c),
+                          '       return "{} {}"'.format(docname, c), '']
+
+            if kids:
+                lines += ['.. toctree::', ''] + ['   ' + kid for kid in kids] + ['']
+
+            with open(path.join(root, docname + '.rst'), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines))
+
+
+def run_build(corpus_root, builder, workers):
+    """
+    Build a generated repository with one builder in a fresh process. Return
+    that process's measurements.
+    """
+
+    with open(path.join(corpus_root, 'conf.py'), 'w', encoding='utf-8') as f:
+        f.write(CONF.format(builder=builder))
+
+    out_root = tempfile.mkdtemp(prefix='deconst-bench-out-')
+    shutil.rmtree(path.join(corpus_root, '_build'), ignore_errors=True)
+
+    env = dict(os.environ,
+               CONTENT_ROOT=corpus_root,
+               ENVELOPE_DIR=path.join(out_root, 'envelopes'),
+               ASSET_DIR=path.join(out_root, 'assets'),
+               MANIFEST_PATH=path.join(out_root, 'manifest.json'),
+               PARALLEL_WORKERS=str(workers),
+               REPORT_DIR=out_root,
+               TIMING_REPORT='true')
+    result_path = path.join(out_root, 'result.json')
+
+    log_path = path.join(out_root, 'build.log')
+
+    try:
+        with open(log_path, 'wb') as log:
+            status = subprocess.call([sys.executable, path.realpath(__file__), '--child', result_path],
+                                     env=env, stdout=log, stderr=subprocess.STDOUT)
+        if status != 0:
+            with open(log_path, 'r', encoding='utf-8', errors='replace') as log:
+                sys.stderr.write(log.read()[-4000:])
+            raise RuntimeError('Building {} with {} failed.'.format(corpus_root, builder))
+
+        with open(result_path, 'r', encoding='utf-8') as f:
+            result = json.load(f)
+        with open(path.join(out_root, 'deconst-timing.json'), 'r', encoding='utf-8') as f:
+            result['phases'] = json.load(f)['phases']
+        return result
+    finally:
+        shutil.rmtree(out_root, ignore_errors=True)
+
+
+def child(result_path):
+    """
+    Run deconstrst.main() within this process and record its wall time and
+    peak memory use.
+    """
+
+    sys.path.insert(0, ROOT)
+
+    import deconstrst
+
+    start = time.perf_counter()
+    deconstrst.main()
+    wall = time.perf_counter() - start
+
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'wall': wall,
+            'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }, f)
+
+
+def result_key(result):
+    # Results recorded before --workers existed always used a single worker.
+    return (result['builder'], result.get('workers', 1), json.dumps(result['corpus'], sort_keys=True))
+
+
+def compare(results, baseline, threshold):
+    """
+    List the builds that have become slower or larger than they were in the
+    baseline results by more than "threshold".
+    """
+
+    previous = {result_key(r): r for r in baseline['results']}
+
+    regressions = []
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+
+        for measure in ('wall', 'max_rss_kib'):
+            if result[measure] > before[measure] * (1 + threshold):
+                regressions.append('{} with {} pages and {} workers: {} went from {:.2f} to {:.2f}'.format(
+                    result['builder'], result['corpus']['pages'], result['workers'], measure,
+                    before[measure], result[measure]))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the preparer on synthetic repositories.')
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 1000],
+                        help='page counts to generate repositories with')
+    parser.add_argument('--depth', type=int, default=3, help='toctree depth')
+    parser.add_argument('--breadth', type=int, default=10, help='toctree entries per page')
+    parser.add_argument('--images', type=int, default=2, help='images per page')
+    parser.add_argument('--distinct-images', type=int, default=20, help='distinct image files')
+    parser.add_argument('--code-blocks', type=int, default=2, help='code blocks per page')
+    parser.add_argument('--paragraphs', type=int, default=5, help='paragraphs per page')
+    parser.add_argument('--builders', nargs='+', default=BUILDERS, choices=BUILDERS)
+    parser.add_argument('--workers', type=int, default=1, help='value of PARALLEL_WORKERS')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='builds of each repository; the fastest is reported')
+    parser.add_argument('--output', help='write results here instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction by which a build may grow before it is reported')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    results = []
+    for pages in args.pages:
+        corpus = Corpus(pages, args.depth, args.breadth, args.images, args.distinct_images,
+                        args.code_blocks, args.paragraphs)
+        corpus_root = tempfile.mkdtemp(prefix='deconst-bench-src-')
+        try:
+            corpus.generate(corpus_root)
+            for builder in args.builders:
+                runs = [run_build(corpus_root, builder, args.workers) for _ in range(args.repeat)]
+                best = min(runs, key=lambda r: r['wall'])
+                best.update(builder=builder, corpus=corpus.describe(), workers=args.workers)
+                results.append(best)
+                print('{:>16} {:>6} pages: {:8.2f}s {:8d}KiB'.format(
+                    builder, pages, best['wall'], best['max_rss_kib']), file=sys.stderr)
+        finally:
+            shutil.rmtree(corpus_root, ignore_errors=True)
+
+    doc = {'revision': git_revision(), 'python': sys.version.split()[0], 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+    else:
+        json.dump(doc, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
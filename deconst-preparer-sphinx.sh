@@ -9,6 +9,19 @@ exec docker run \
   -e CONTENT_ID_BASE=${CONTENT_ID_BASE:-} \
   -e ENVELOPE_DIR=${ENVELOPE_DIR:-} \
   -e ASSET_DIR=${ASSET_DIR:-} \
+  -e MANIFEST_PATH=${MANIFEST_PATH:-} \
+  -e OUTPUT_STREAM=${OUTPUT_STREAM:-} \
+  -e OUTPUT_FORMAT=${OUTPUT_FORMAT:-} \
+  -e OUTPUT_ASSETS=${OUTPUT_ASSETS:-} \
+  -e INCREMENTAL_BUILD=${INCREMENTAL_BUILD:-} \
+  -e PARALLEL_WORKERS=${PARALLEL_WORKERS:-} \
+  -e JSON_SERIALIZER=${JSON_SERIALIZER:-} \
+  -e REQUIREMENTS_CACHE_DIR=${REQUIREMENTS_CACHE_DIR:-} \
+  -e REPORT_DIR=${REPORT_DIR:-} \
+  -e TIMING_REPORT=${TIMING_REPORT:-} \
+  -e MEMORY_REPORT=${MEMORY_REPORT:-} \
+  -e DOCUMENT_REPORT=${DOCUMENT_REPORT:-} \
+  -e DOCUMENT_REPORT_TOP=${DOCUMENT_REPORT_TOP:-} \
   -e VERBOSE=${VERBOSE:-} \
   -v ${CONTENT_ROOT}:/usr/content-repo \
   quay.io/deconst/preparer-sphinx
@@ -2,48 +2,117 @@
 
 import os
 import sys
+import time
+from contextlib import redirect_stdout
 
+import pkg_resources
 from pip import pip
 from deconstrst.deconstrst import build, get_conf_builder
 from deconstrst.config import Configuration
+from deconstrst.memory import MemoryTracker
+from deconstrst.timing import timer
+from deconstrst.watch import watch_and_rebuild
 
 __author__ = 'Ash Wilson'
 __email__ = 'ash.wilson@rackspace.com'
 __version__ = '0.1.0'
 
 
-def main(directory=False):
+def main(directory=False, watch=False, timing=False):
 
-    config = Configuration(os.environ)
-
-    if config.content_root:
-        if directory and directory != config.content_root:
-            print("Warning: Overriding CONTENT_ROOT [{}] with argument [{}].".format(config.content_root, directory))
+    content_root = os.environ.get("CONTENT_ROOT", None)
+    if content_root:
+        if directory and directory != content_root:
+            print("Warning: Overriding CONTENT_ROOT [{}] with argument [{}].".format(content_root, directory),
+                  file=sys.stderr)
         else:
-            os.chdir(config.content_root)
+            os.chdir(content_root)
     elif directory:
         os.chdir(directory)
 
-    if os.path.exists("_deconst.json"):
-        with open("_deconst.json", "r", encoding="utf-8") as cf:
-            config.apply_file(cf)
+    config = Configuration.load(os.environ)
+
+    timer.reset()
+    timer.enabled = bool(timing or config.timing_report or config.memory_report)
+    timer.memory = None
+    if config.memory_report:
+        timer.memory = MemoryTracker()
+        timer.memory.start()
+    started = time.perf_counter()
+
+    try:
+        # When envelopes are streamed to stdout, everything else goes to stderr.
+        if config.output_stream == '-':
+            with redirect_stdout(sys.stderr):
+                prepare(config, watch)
+        else:
+            prepare(config, watch)
+    finally:
+        if config.timing_report:
+            timer.write(config.timing_report, time.perf_counter() - started)
+        if timer.memory:
+            timer.memory.write(config.memory_report)
+            timer.memory.stop()
+            timer.memory = None
+
+
+def prepare(config, watch=False):
+    """
+    Build the content found in the current directory with a loaded
+    configuration. When "watch" is set, build it again each time it changes.
+    """
+
+    check_settings(config)
 
     # Ensure that the envelope and asset directories exist.
     os.makedirs(config.envelope_dir, exist_ok=True)
     os.makedirs(config.asset_dir, exist_ok=True)
 
     # Install pip requirements when possible.
-    install_requirements()
+    with timer.phase('install_requirements'):
+        install_requirements(config.requirements_cache_dir)
 
     # Lock source and destination to the same paths as the Makefile.
     srcdir = '.'
-    destdir = os.path.join('_build', get_conf_builder(srcdir))
+    if watch:
+        check_configuration(config)
+        watch_and_rebuild(srcdir, config)
+        return
+
+    with timer.phase('conf_builder'):
+        conf_builder = get_conf_builder(srcdir)
+    destdir = os.path.join('_build', conf_builder)
 
-    status = build(srcdir, destdir)
+    status = build(srcdir, destdir,
+                   incremental=bool(config.incremental),
+                   parallel=config.workers or 1,
+                   builder=conf_builder,
+                   deconst_config=config)
     if status != 0:
         sys.exit(status)
 
-    reasons = config.missing_values()
+    check_configuration(config)
+
+def check_settings(config):
+    """
+    Exit before building if the configuration includes values that can't be
+    used.
+    """
+
+    exit_with_reasons(config.invalid_values())
+
+def check_configuration(config):
+    """
+    Exit if the configuration lacks values that preparing content requires.
+    """
+
+    exit_with_reasons(config.missing_values())
+
+def exit_with_reasons(reasons):
+    """
+    Explain why content isn't being prepared and exit, if there's a reason.
+    """
+
     if reasons:
         print("Not preparing content because:", file=sys.stderr)
         print(file=sys.stderr)
@@ -52,10 +121,13 @@ def main(directory=False):
         print(file=sys.stderr)
         sys.exit(1)
 
-def install_requirements():
+def install_requirements(cache_dir=None):
     """
     Install non-colliding dependencies from a "requirements.txt" file found at
     the content root.
+
+    Wheels are cached in "cache_dir". When every dependency is already
+    installed within the running Python environment, pip is skipped entirely.
     """
 
     reqfile = None
@@ -79,8 +151,41 @@ def install_requirements():
 
             dependencies.append(stripped)
 
+    start = time.time()
+
+    if requirements_installed(dependencies):
+        print("Dependencies from {} are already installed. Skipped in {:.2f}s."
+              .format(reqfile, time.time() - start))
+        return
+
     print("Installing dependencies from {}: {}.".format(reqfile, ', '.join(dependencies)))
-    pip.main(['install'] + dependencies)
+
+    args = ['install']
+    if cache_dir:
+        args += ['--cache-dir', cache_dir]
+    status = pip.main(args + dependencies)
+
+    if status != 0:
+        print("Unable to install dependencies from {}. pip exited with status {} after {:.2f}s."
+              .format(reqfile, status, time.time() - start), file=sys.stderr)
+        return
+
+    print("Installed dependencies from {} in {:.2f}s.".format(reqfile, time.time() - start))
+
+def requirements_installed(dependencies):
+    """
+    Determine whether or not every dependency, and everything that it requires
+    in turn, is installed within the running Python environment. Lines that
+    aren't plain requirement specifiers, such as URLs or pip options, are
+    always left to pip.
+    """
+
+    try:
+        # A fresh working set sees packages installed since startup.
+        pkg_resources.WorkingSet().require(*dependencies)
+    except (pkg_resources.ResolutionError, ValueError):
+        return False
+    return True
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import argparse
+
 from . import main
 
-main()
+parser = argparse.ArgumentParser(prog='python -m deconstrst',
+                                 description='Prepare Sphinx content as deconst envelopes.')
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--watch', action='store_true',
+                  help='keep running, and rebuild the content each time it changes')
+mode.add_argument('--serve', metavar='ADDRESS',
+                  help='answer build requests on a local port, or on a Unix socket given as unix:PATH')
+args = parser.parse_args()
+
+if args.serve:
+    from .server import serve
+    serve(args.serve)
+else:
+    main(watch=args.watch)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Publication of the assets referenced by rendered documents.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from docutils import nodes
+from deconstrst.timing import timer
+
+# Number of background threads used to copy assets.
+COPY_THREADS = 4
+
+# Number of copies that may be waiting for a thread before publish() blocks.
+MAX_PENDING_COPIES = 64
+
+
+def resolve_asset(deconst_config, uri):
+    """
+    Map an image URI to its source path, its path relative to the asset
+    directory, and the destination path it should be published to.
+    """
+
+    asset_src_root = path.realpath('_images') # This is actually hardcoded in StandaloneHTMLBuilder
+    asset_dest_root = path.realpath(deconst_config.asset_dir)
+
+    asset_src_path = path.realpath(uri)
+    if asset_src_path.startswith(asset_src_root):
+        asset_rel_path = path.relpath(asset_src_path, asset_src_root)
+    else:
+        asset_rel_path = asset_src_path[1:]
+    asset_dest_path = path.join(asset_dest_root, asset_rel_path)
+
+    return asset_src_path, asset_rel_path, asset_dest_path
+
+
+def file_digest(filename):
+    """
+    Compute the SHA-256 digest of a file's contents.
+    """
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _is_current(asset_src_path, asset_dest_path):
+    """
+    Determine whether or not a published asset already matches its source.
+    """
+
+    try:
+        dest_stat = os.stat(asset_dest_path)
+    except FileNotFoundError:
+        return False
+
+    src_stat = os.stat(asset_src_path)
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    if src_stat.st_mtime == dest_stat.st_mtime:
+        return True
+
+    return file_digest(asset_src_path) == file_digest(asset_dest_path)
+
+
+@timer.timed('assets')
+def _copy_asset(asset_src_path, asset_dest_path):
+    """
+    Copy an asset unless the destination is already current. Return whether or
+    not a copy was made, along with the asset's digest and size.
+    """
+
+    digest, size = file_digest(asset_src_path), path.getsize(asset_src_path)
+
+    if _is_current(asset_src_path, asset_dest_path):
+        return False, digest, size
+
+    os.makedirs(path.dirname(asset_dest_path), exist_ok=True)
+    # Preserve the mtime so that the next build can skip this copy.
+    shutil.copy2(asset_src_path, asset_dest_path)
+    return True, digest, size
+
+
+@timer.timed('assets')
+def _stream_asset(stream, asset_rel_path, asset_src_path):
+    """
+    Add an asset to the output stream. Return the same results as _copy_asset.
+    """
+
+    digest, size = file_digest(asset_src_path), path.getsize(asset_src_path)
+    stream.add_asset(asset_rel_path, asset_src_path)
+    return True, digest, size
+
+
+class AssetPublisher:
+    """
+    Copy each asset referenced during a build into the asset directory at most
+    once, and remember what was published.
+
+    Copies are made by a bounded pool of background threads, so that rendering
+    doesn't wait on disk I/O. Call join() to wait for them to complete.
+    """
+
+    def __init__(self, deconst_config, manifest, stream=None):
+        self.deconst_config = deconst_config
+        self.manifest = manifest
+        self.stream = stream
+
+        # Maps the asset-relative path of each published asset to its source.
+        self.published = {}
+
+        self.copied = 0
+        self.unchanged = 0
+
+        self._executor = None
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(MAX_PENDING_COPIES)
+
+    def publish(self, uri):
+        """
+        Publish the asset at a source URI unless it's already been handled
+        during this build. Return its path relative to the asset directory.
+        """
+
+        asset_src_path, asset_rel_path, asset_dest_path = resolve_asset(self.deconst_config, uri)
+        if asset_rel_path in self.published:
+            return asset_rel_path
+        self.published[asset_rel_path] = asset_src_path
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=COPY_THREADS)
+
+        # Block while too many copies are outstanding.
+        self._slots.acquire()
+        if self.stream:
+            future = self._executor.submit(_stream_asset, self.stream, asset_rel_path, asset_src_path)
+        else:
+            future = self._executor.submit(_copy_asset, asset_src_path, asset_dest_path)
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append((asset_rel_path, future))
+
+        return asset_rel_path
+
+    def join(self):
+        """
+        Wait for all outstanding copies to finish. Raise the first error that
+        any of them encountered.
+        """
+
+        if self._executor is None:
+            return
+
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+        futures, self._futures = self._futures, []
+        for asset_rel_path, future in futures:
+            copied, digest, size = future.result()
+            if copied:
+                self.copied += 1
+            else:
+                self.unchanged += 1
+            self.manifest.add_asset(asset_rel_path, digest, size)
+
+    def publish_images(self, doctree):
+        """
+        Publish each image referenced by a doctree.
+
+        This is called from the main process before the doctree is translated,
+        so that worker processes never write to the asset directory themselves.
+        """
+
+        for node in doctree.traverse(nodes.image):
+            self.publish(node['uri'])
+
+    def summary(self):
+        """
+        Describe the assets published during this build.
+        """
+
+        return '{} published, {} copied, {} unchanged'.format(
+            len(self.published), self.copied, self.unchanged)
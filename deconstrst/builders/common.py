@@ -7,7 +7,13 @@ import os
 import glob
 from os import path
 
+from sphinx.util.console import bold
 from deconstrst.config import Configuration
+from deconstrst.timing import timer
+from deconstrst.builders.assets import AssetPublisher
+from deconstrst.builders.manifest import Manifest
+from deconstrst.builders.output import EnvelopeWriter, open_stream
+from deconstrst.builders.profile import DocumentProfile
 from deconstrst.builders.writer import OffsetHTMLTranslator
 
 
@@ -18,11 +24,85 @@ def init_builder(builder):
 
     builder.translator_class = OffsetHTMLTranslator
 
-    builder.deconst_config = Configuration(os.environ)
+    # Builders run by deconstrst.build() share the entry point's configuration.
+    builder.deconst_config = getattr(builder.app, 'deconst_config', None)
+    if builder.deconst_config is None:
+        builder.deconst_config = Configuration.load(os.environ)
 
-    if path.exists('_deconst.json'):
-        with open('_deconst.json', 'r', encoding='utf-8') as cf:
-            builder.deconst_config.apply_file(cf)
+    builder.document_profile = None
+    if builder.deconst_config.document_report:
+        builder.document_profile = DocumentProfile()
+        builder.document_profile.connect(builder.app)
+
+    open_outputs(builder, prune=not builder.deconst_config.incremental)
+
+def open_outputs(builder, prune):
+    """
+    Prepare the manifest, output stream and writers used by a single build.
+    cleanup_builder() closes them again, so a builder that's used for several
+    builds must call this before each one after the first. When "prune" is
+    set, envelopes that the build doesn't produce are removed at cleanup.
+    """
+
+    builder.prune_stale_envelopes = prune
+
+    builder.manifest = Manifest(builder.deconst_config)
+    builder.output_stream = open_stream(builder.deconst_config)
+
+    asset_stream = None
+    if builder.deconst_config.output_assets:
+        asset_stream = builder.output_stream
+
+    if builder.document_profile:
+        builder.document_profile.reset()
+
+    builder.asset_publisher = AssetPublisher(builder.deconst_config, builder.manifest, asset_stream)
+    builder.envelope_writer = EnvelopeWriter(builder.deconst_config, builder.manifest,
+                                             builder.output_stream, builder.document_profile)
+
+def close_outputs(builder):
+    """
+    Wait for background writes to finish, save the manifest and close the
+    output stream after a build that failed before cleanup_builder() ran.
+    """
+
+    try:
+        builder.envelope_writer.join()
+        builder.asset_publisher.join()
+    finally:
+        builder.manifest.save()
+        if builder.output_stream:
+            builder.output_stream.close()
+
+@timer.timed('cleanup')
+def cleanup_builder(builder):
+    """
+    Common Builder cleanup. Wait for background work to complete, remove
+    envelopes that a full build no longer produces, write the manifest and
+    report what this build has published, and how long each document took if
+    that was requested.
+    """
+
+    builder.envelope_writer.join()
+    builder.asset_publisher.join()
+
+    if builder.prune_stale_envelopes:
+        for content_id, envelope_path in builder.manifest.stale_envelopes():
+            builder.envelope_writer.remove(content_id, envelope_path)
+
+    builder.manifest.save()
+
+    if builder.output_stream:
+        builder.output_stream.close()
+
+    builder.info(bold('publishing assets... ') + builder.asset_publisher.summary())
+    builder.info(bold('writing envelopes... ') + builder.envelope_writer.summary())
+
+    if builder.document_profile:
+        builder.document_profile.collect_reads(builder.env)
+        builder.document_profile.write(builder.deconst_config.document_report)
+        for line in builder.document_profile.summary(builder.deconst_config.document_report_top):
+            builder.info(line)
 
 def derive_content_id(deconst_config, docname):
     """
@@ -1,19 +1,66 @@
 # -*- coding: utf-8 -*-
 
-import os
 import urllib
 import re
 from os import path
 
 from .common import derive_content_id
 
+# Separates the categories listed in a page's "deconstcategories" metadata.
+CATEGORY_SEPARATOR = re.compile(r"\s*,\s*")
+
+
+def serialization_path(deconst_config, content_id):
+    """
+    Generate the full path at which the envelope for a content ID should be
+    serialized.
+    """
+
+    envelope_filename = urllib.parse.quote(content_id, safe='') + '.json'
+    return path.join(deconst_config.envelope_dir, envelope_filename)
+
+
+class EnvelopeContext:
+    """
+    Settings shared by every envelope produced during a build, derived once
+    from the Sphinx and deconst configurations.
+    """
+
+    def __init__(self, config, deconst_config):
+        self.deconst_config = deconst_config
+
+        self.meta = dict(deconst_config.meta)
+
+        self.source_suffix = config.source_suffix[0]
+        self.edit_url_prefix = None
+        if deconst_config.git_root and deconst_config.github_url:
+            edit_segments = [deconst_config.github_url, 'edit', deconst_config.github_branch]
+            self.edit_url_prefix = '/'.join(segment.strip('/') for segment in edit_segments)
+
+        self.default_unsearchable = config.deconst_default_unsearchable
+        self.default_layout = config.deconst_default_layout
+
+        self.global_categories = None
+        if config.deconst_categories is not None:
+            self.global_categories = frozenset(config.deconst_categories)
+
+
 class Envelope:
     """
     A metadata envelope-in-waiting.
+
+    Only the values that will be serialized are retained, along with the
+    shared build context, so that many envelopes can be held at once. The
+    docwriter and per-page metadata are consulted during construction and then
+    released. The payload itself is assembled on demand.
     """
 
-    def __init__(self, docname, body, title, toc, builder, deconst_config,
-                 per_page_meta, docwriter):
+    __slots__ = ('docname', 'body', 'title', 'toc', 'content_id', 'unsearchable',
+                 'layout_key', 'categories', 'meta', 'asset_offsets', 'next',
+                 'previous', 'addenda', 'context')
+
+    def __init__(self, docname, body, title, toc, context, per_page_meta,
+                 docwriter):
         self.docname = docname
 
         self.body = body
@@ -31,19 +78,16 @@ class Envelope:
         self.previous = None
         self.addenda = None
 
-        self.builder = builder
-        self.deconst_config = deconst_config
-        self.per_page_meta = per_page_meta
-        self.docwriter = docwriter
+        self.context = context
 
-        self._populate_meta()
+        self._populate_meta(per_page_meta)
         self._populate_git()
-        self._populate_unsearchable()
-        self._populate_layout_key()
-        self._populate_categories()
-        self._populate_asset_offsets()
+        self._populate_unsearchable(per_page_meta)
+        self._populate_layout_key(per_page_meta)
+        self._populate_categories(per_page_meta)
+        self._populate_asset_offsets(docwriter)
         self._populate_content_id()
-        self._override_title()
+        self._override_title(per_page_meta)
 
     def set_next(self, n):
         if not n:
@@ -65,8 +109,7 @@ class Envelope:
         Generate the full path at which this envelope should be serialized.
         """
 
-        envelope_filename = urllib.parse.quote(self.content_id, safe='') + '.json'
-        return path.join(self.deconst_config.envelope_dir, envelope_filename)
+        return serialization_path(self.context.deconst_config, self.content_id)
 
     def serialization_payload(self):
         """
@@ -100,84 +143,75 @@ class Envelope:
 
         return payload
 
-    def _populate_meta(self):
+    def _populate_meta(self, per_page_meta):
         """
         Merge repository-global and per-page metadata into the envelope's
         metadata.
         """
 
-        self.meta = self.deconst_config.meta.copy()
-        self.meta.update(self.per_page_meta)
+        self.meta = self.context.meta.copy()
+        self.meta.update(per_page_meta)
 
     def _populate_git(self):
         """
         Set the github_edit_url property within "meta".
         """
 
-        if self.deconst_config.git_root and self.deconst_config.github_url:
-            full_path = path.join(os.getcwd(),
-                                  self.builder.env.srcdir,
-                                  self.docname + self.builder.config.source_suffix[0])
-
-            edit_segments = [
-                self.deconst_config.github_url,
-                'edit',
-                self.deconst_config.github_branch,
-                path.relpath(full_path, self.builder.env.srcdir)
-            ]
-
-            self.meta['github_edit_url'] = '/'.join(segment.strip('/') for segment in edit_segments)
+        if self.context.edit_url_prefix:
+            source_path = self.docname + self.context.source_suffix
+            self.meta['github_edit_url'] = self.context.edit_url_prefix + '/' + source_path.strip('/')
 
-    def _populate_unsearchable(self):
+    def _populate_unsearchable(self, per_page_meta):
         """
         Populate "unsearchable" from per-page or repository-wide settings.
         """
 
-        unsearchable = self.per_page_meta.get('deconstunsearchable',
-                                              self.builder.config.deconst_default_unsearchable)
+        unsearchable = per_page_meta.get('deconstunsearchable',
+                                         self.context.default_unsearchable)
         if unsearchable is not None:
             self.unsearchable = unsearchable in ('true', True)
 
-    def _populate_layout_key(self):
+    def _populate_layout_key(self, per_page_meta):
         """
         Derive the "layout_key" from per-page or repository-wide configuration.
         """
 
-        default_layout = self.builder.config.deconst_default_layout
-        self.layout_key = self.per_page_meta.get('deconstlayout', default_layout)
+        self.layout_key = per_page_meta.get('deconstlayout', self.context.default_layout)
 
-    def _populate_categories(self):
+    def _populate_categories(self, per_page_meta):
         """
         Unify global and per-page categories.
         """
 
-        page_cats = self.per_page_meta.get('deconstcategories')
-        global_cats = self.builder.config.deconst_categories
+        page_cats = per_page_meta.get('deconstcategories')
+        global_cats = self.context.global_categories
         if page_cats is not None or global_cats is not None:
             cats = set()
             if page_cats is not None:
-                cats.update(re.split("\s*,\s*", page_cats))
-            cats.update(global_cats or [])
-            self.categories = list(cats)
+                cats.update(CATEGORY_SEPARATOR.split(page_cats))
+            cats.update(global_cats or ())
+            # Sort for a stable serialization from one build to the next.
+            self.categories = sorted(cats)
 
-    def _populate_asset_offsets(self):
+    def _populate_asset_offsets(self, docwriter):
         """
-        Read stored asset offsets from the docwriter.
+        Read stored asset offsets from the docwriter, if there is one.
         """
 
-        self.asset_offsets = self.docwriter.visitor.calculate_offsets()
+        if docwriter is not None:
+            self.asset_offsets = docwriter.visitor.calculate_offsets()
 
     def _populate_content_id(self):
         """
         Derive this envelope's content ID.
         """
 
-        self.content_id = derive_content_id(self.deconst_config, self.docname)
+        self.content_id = derive_content_id(self.context.deconst_config, self.docname)
 
-    def _override_title(self):
+    def _override_title(self, per_page_meta):
         """
         Override the envelope's title if requested by page metadata.
         """
 
-        if 'deconsttitle' in self.per_page_meta:
-            self.title = self.per_page_meta['deconsttitle']
+        if 'deconsttitle' in per_page_meta:
+            self.title = per_page_meta['deconsttitle']
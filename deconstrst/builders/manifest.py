@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+A single file that describes every envelope and asset produced by a build.
+"""
+
+import json
+import os
+from os import path
+
+
+class Manifest:
+    """
+    Track the envelopes and assets produced by this content repository.
+
+    The manifest from the previous build is loaded first, so that incremental
+    builds retain the entries of documents that weren't written again.
+    """
+
+    def __init__(self, deconst_config):
+        self.deconst_config = deconst_config
+
+        self.envelopes = {}
+        self.assets = {}
+
+        # Content IDs written or confirmed during this build.
+        self.produced = set()
+
+        self._load()
+
+    def _load(self):
+        """
+        Read the previous manifest, if there is one, as long as it describes
+        the same envelope and asset directories.
+        """
+
+        try:
+            with open(self.deconst_config.manifest_path, 'r', encoding='utf-8') as mf:
+                doc = json.load(mf)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if doc.get('envelopeDir') != path.realpath(self.deconst_config.envelope_dir):
+            return
+        if doc.get('assetDir') != path.realpath(self.deconst_config.asset_dir):
+            return
+
+        self.envelopes = doc.get('envelopes', {})
+        self.assets = {rel: {'sha256': a['sha256'], 'size': a['size']}
+                       for rel, a in doc.get('assets', {}).items()}
+
+    def add_envelope(self, content_id, filename, digest, size, assets):
+        """
+        Record an envelope produced by this build.
+        """
+
+        self.envelopes[content_id] = {
+            'path': path.basename(filename),
+            'sha256': digest,
+            'size': size,
+            'assets': sorted(assets),
+        }
+        self.produced.add(content_id)
+
+    def remove_envelope(self, content_id):
+        """
+        Forget an envelope that's no longer produced.
+        """
+
+        self.envelopes.pop(content_id, None)
+        self.produced.discard(content_id)
+
+    def add_asset(self, asset_rel_path, digest, size):
+        """
+        Record the content of an asset published by this build.
+        """
+
+        self.assets[asset_rel_path] = {'sha256': digest, 'size': size}
+
+    def stale_envelopes(self):
+        """
+        List the content IDs recorded by a previous build that this build has
+        not produced, along with their envelope paths.
+        """
+
+        return [(content_id, path.join(self.deconst_config.envelope_dir, e['path']))
+                for content_id, e in self.envelopes.items()
+                if content_id not in self.produced]
+
+    def save(self):
+        """
+        Write the manifest. Only assets referenced by a current envelope are
+        included.
+        """
+
+        references = {}
+        for content_id, e in self.envelopes.items():
+            for asset_rel_path in e['assets']:
+                references.setdefault(asset_rel_path, []).append(content_id)
+
+        assets = {}
+        for asset_rel_path, content_ids in references.items():
+            asset = self.assets.get(asset_rel_path)
+            if asset is None:
+                continue
+            assets[asset_rel_path] = dict(asset, contentIDs=sorted(content_ids))
+
+        doc = {
+            'contentIDBase': self.deconst_config.content_id_base,
+            'envelopeDir': path.realpath(self.deconst_config.envelope_dir),
+            'assetDir': path.realpath(self.deconst_config.asset_dir),
+            'envelopes': self.envelopes,
+            'assets': assets,
+        }
+
+        manifest_path = self.deconst_config.manifest_path
+        os.makedirs(path.dirname(path.abspath(manifest_path)), exist_ok=True)
+
+        # Replace the manifest atomically so that readers never see a partial one.
+        partial_path = manifest_path + '.partial'
+        with open(partial_path, 'w', encoding='utf-8') as mf:
+            json.dump(doc, mf, indent=2, sort_keys=True)
+        os.replace(partial_path, manifest_path)
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization of envelopes into the envelope directory or an output stream.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import queue
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from deconstrst.timing import timer
+from .assets import file_digest
+from .serializer import get_serializer
+
+# Number of background threads that serialize and write envelopes.
+WRITER_THREADS = 2
+
+# Number of envelopes that may be waiting for a thread before write() blocks.
+MAX_PENDING_ENVELOPES = 32
+
+
+class EnvelopeWriter:
+    """
+    Write envelopes to disk, leaving any envelope whose serialized payload is
+    identical to the existing file untouched so that its mtime is preserved.
+
+    Envelopes are serialized and written by background threads that drain a
+    bounded queue, so that rendering doesn't wait on output I/O. Call join() to
+    wait for them to finish.
+    """
+
+    def __init__(self, deconst_config, manifest, stream=None, profile=None):
+        self.deconst_config = deconst_config
+        self.manifest = manifest
+        self.stream = stream
+        self.profile = profile
+        self.serializer = get_serializer(deconst_config.json_serializer)
+
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+
+        self._queue = None
+        self._threads = []
+        self._errors = []
+        self._lock = threading.Lock()
+
+    def write(self, content_id, payload, filename):
+        """
+        Queue an envelope payload to be written. Block while the queue is full.
+        """
+
+        self._enqueue((content_id, payload, filename))
+
+    def write_envelope(self, envelope):
+        """
+        Queue an Envelope to be written. Its payload is assembled by the writer
+        thread. Block while the queue is full.
+        """
+
+        self._enqueue((envelope.content_id, envelope, envelope.serialization_path()))
+
+    def _enqueue(self, item):
+        """
+        Start the writer threads if necessary, then queue an item for them.
+        """
+
+        if self._queue is None:
+            self._queue = queue.Queue(maxsize=MAX_PENDING_ENVELOPES)
+            for _ in range(WRITER_THREADS):
+                thread = threading.Thread(target=self._drain, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        self._queue.put(item)
+
+    def join(self):
+        """
+        Wait for all queued envelopes to be written. Raise the first error that
+        any writer thread encountered.
+        """
+
+        if self._queue is None:
+            return
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        self._queue = None
+        self._threads = []
+
+        if self._errors:
+            raise self._errors[0]
+
+    def _drain(self):
+        """
+        Write queued envelopes until a None sentinel arrives.
+        """
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            try:
+                self._write(*item)
+            except BaseException as e:
+                with self._lock:
+                    self._errors.append(e)
+
+    @timer.timed('serialize')
+    def _write(self, content_id, payload, filename):
+        """
+        Serialize an envelope payload to a file unless that file already
+        contains the same bytes. "payload" may also be an Envelope.
+        """
+
+        started = time.perf_counter()
+
+        if not isinstance(payload, dict):
+            payload = payload.serialization_payload()
+
+        data = self.serializer.dumps(payload)
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            self.manifest.add_envelope(content_id, filename, digest, len(data),
+                                       payload.get('asset_offsets') or ())
+
+        if self.stream:
+            self.stream.add_envelope(content_id, os.path.basename(filename), data)
+            written = True
+        elif _is_current(filename, len(data), digest):
+            written = False
+        else:
+            with open(filename, 'wb') as f:
+                f.write(data)
+            written = True
+
+        self._count(content_id, written, started)
+
+    @timer.timed('serialize')
+    def write_streaming(self, envelope):
+        """
+        Write an Envelope whose body is a list of string chunks, from the
+        calling thread. The body is encoded and written a chunk at a time, so
+        it's never held in memory as a single string.
+        """
+
+        started = time.perf_counter()
+
+        payload = envelope.serialization_payload()
+        body_chunks = payload.pop('body')
+        filename = envelope.serialization_path()
+
+        # A streamed envelope is only staged on disk on its way into the
+        # stream, so keep it out of the envelope directory.
+        if self.stream:
+            fd, partial_path = tempfile.mkstemp(suffix='.partial')
+            f = os.fdopen(fd, 'wb')
+        else:
+            partial_path = filename + '.partial'
+            f = open(partial_path, 'wb')
+
+        digest, size = hashlib.sha256(), 0
+        with f:
+            for piece in self.serializer.iter_dumps(payload, body_chunks):
+                digest.update(piece)
+                size += len(piece)
+                f.write(piece)
+        digest = digest.hexdigest()
+
+        with self._lock:
+            self.manifest.add_envelope(envelope.content_id, filename, digest, size,
+                                       payload.get('asset_offsets') or ())
+
+        if self.stream:
+            try:
+                self.stream.add_envelope_file(envelope.content_id, os.path.basename(filename),
+                                              partial_path)
+            finally:
+                os.remove(partial_path)
+            written = True
+        elif _is_current(filename, size, digest):
+            os.remove(partial_path)
+            written = False
+        else:
+            os.replace(partial_path, filename)
+            written = True
+
+        self._count(envelope.content_id, written, started)
+
+    def _count(self, content_id, written, started):
+        """
+        Tally an envelope that's been handled, and profile it if requested.
+        """
+
+        with self._lock:
+            if written:
+                self.written += 1
+            else:
+                self.unchanged += 1
+
+        if self.profile:
+            self.profile.record_envelope(content_id, 'serialize', time.perf_counter() - started)
+
+    def remove(self, content_id, filename):
+        """
+        Remove an envelope that's no longer produced by this repository.
+        """
+
+        with self._lock:
+            self.manifest.remove_envelope(content_id)
+
+        if self.stream:
+            self.stream.remove_envelope(content_id)
+        else:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                return
+
+        with self._lock:
+            self.removed += 1
+
+    def summary(self):
+        """
+        Describe the envelopes handled during this build.
+        """
+
+        return '{} written, {} unchanged, {} removed'.format(
+            self.written, self.unchanged, self.removed)
+
+
+def _is_current(filename, size, digest):
+    """
+    Determine whether or not an existing file already holds exactly "size"
+    bytes whose SHA-256 digest is "digest".
+    """
+
+    try:
+        if os.path.getsize(filename) != size:
+            return False
+    except FileNotFoundError:
+        return False
+
+    return file_digest(filename) == digest
+
+
+class NDJSONStream:
+    """
+    Write envelopes and assets as newline-delimited JSON records.
+
+    Each envelope becomes {"contentID": ..., "envelope": {...}}. Each asset
+    becomes {"asset": ..., "content": "<base64>"}. Envelopes that are no longer
+    produced become {"contentID": ..., "removed": true}.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self._lock = threading.Lock()
+
+    def add_envelope(self, content_id, name, data):
+        record = b''.join([b'{"contentID": ', json.dumps(content_id).encode('utf-8'),
+                           b', "envelope": ', data, b'}\n'])
+        self._write(record)
+
+    def add_envelope_file(self, content_id, name, filename):
+        prefix = b''.join([b'{"contentID": ', json.dumps(content_id).encode('utf-8'),
+                           b', "envelope": '])
+        with open(filename, 'rb') as ef, self._lock:
+            self.f.write(prefix)
+            shutil.copyfileobj(ef, self.f)
+            self.f.write(b'}\n')
+
+    def add_asset(self, asset_rel_path, asset_src_path):
+        with open(asset_src_path, 'rb') as af:
+            content = base64.b64encode(af.read()).decode('ascii')
+        record = json.dumps({'asset': asset_rel_path, 'content': content}, sort_keys=True)
+        self._write(record.encode('utf-8') + b'\n')
+
+    def remove_envelope(self, content_id):
+        record = json.dumps({'contentID': content_id, 'removed': True}, sort_keys=True)
+        self._write(record.encode('utf-8') + b'\n')
+
+    def _write(self, record):
+        with self._lock:
+            self.f.write(record)
+
+    def close(self):
+        self.f.flush()
+        if self.f is not sys.__stdout__.buffer:
+            self.f.close()
+
+
+class TarStream:
+    """
+    Write envelopes and assets into an uncompressed tar stream, laid out as the
+    "envelopes" and "assets" directories would be on disk.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.tar = tarfile.open(fileobj=f, mode='w|')
+        self._lock = threading.Lock()
+
+    def add_envelope(self, content_id, name, data):
+        info = tarfile.TarInfo('envelopes/' + name)
+        info.size = len(data)
+        info.mtime = time.time()
+        with self._lock:
+            self.tar.addfile(info, io.BytesIO(data))
+
+    def add_envelope_file(self, content_id, name, filename):
+        info = tarfile.TarInfo('envelopes/' + name)
+        info.size = os.path.getsize(filename)
+        info.mtime = time.time()
+        with open(filename, 'rb') as ef, self._lock:
+            self.tar.addfile(info, ef)
+
+    def add_asset(self, asset_rel_path, asset_src_path):
+        with self._lock:
+            self.tar.add(asset_src_path, arcname='assets/' + asset_rel_path)
+
+    def remove_envelope(self, content_id):
+        """
+        A tar stream can't express removal. The manifest reflects it instead.
+        """
+
+    def close(self):
+        self.tar.close()
+        self.f.flush()
+        if self.f is not sys.__stdout__.buffer:
+            self.f.close()
+
+
+# Classes that write each OUTPUT_FORMAT.
+STREAM_FORMATS = {
+    'ndjson': NDJSONStream,
+    'tar': TarStream,
+}
+
+
+def open_stream(deconst_config):
+    """
+    Open the single output stream requested by the configuration, or return
+    None to write individual files.
+    """
+
+    if not deconst_config.output_stream:
+        return None
+
+    stream_class = STREAM_FORMATS.get(deconst_config.output_format)
+    if stream_class is None:
+        raise ValueError("Unknown OUTPUT_FORMAT [{}]. Choose one of: {}."
+                         .format(deconst_config.output_format, ', '.join(sorted(STREAM_FORMATS))))
+
+    if deconst_config.output_stream == '-':
+        # main() redirects everything else that would be printed to stderr.
+        f = sys.__stdout__.buffer
+    else:
+        f = open(deconst_config.output_stream, 'wb')
+
+    return stream_class(f)
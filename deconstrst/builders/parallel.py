@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Process-based task execution for parallel reads and writes.
+"""
+
+import time
+
+from sphinx.errors import SphinxParallelError
+from sphinx.util import parallel
+
+
+class ParallelTasks(parallel.ParallelTasks):
+    """
+    Sphinx's ParallelTasks never forgets the pipe of a finished task, so the
+    next poll() reports EOF on it and recv() raises EOFError. Drop each pipe as
+    soon as its result has been received.
+    """
+
+    def _join_one(self):
+        for tid, pipe in self._precvs.items():
+            if pipe.poll():
+                exc, result = pipe.recv()
+                if exc:
+                    raise SphinxParallelError(*result)
+                self._result_funcs.pop(tid)(self._args.pop(tid), result)
+                self._procs.pop(tid).join()
+                del self._precvs[tid]
+                self._pworking -= 1
+                break
+        else:
+            time.sleep(0.02)
+        while self._precvsWaiting and self._pworking < self.nproc:
+            newtid, newprecv = self._precvsWaiting.popitem()
+            self._precvs[newtid] = newprecv
+            self._procs[newtid].start()
+            self._pworking += 1
+
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Per-document measurements, used to find the documents that dominate a build.
+"""
+
+import json
+import threading
+import time
+
+# Columns that hold times, in seconds.
+TIME_COLUMNS = ('read', 'translate', 'serialize')
+
+
+class DocumentProfile:
+    """
+    Record how long each document took to read, translate and serialize, along
+    with the size of its body and the number of images it references.
+
+    Serialization happens on the envelope writer's threads, which only know
+    content IDs, so those times are kept separately and matched to documents
+    when the report is assembled.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.envelopes = {}
+
+        self._lock = threading.Lock()
+
+    def record(self, docname, column, value):
+        """
+        Add a value to one column of a document's row.
+        """
+
+        with self._lock:
+            row = self.documents.setdefault(docname, {})
+            row[column] = row.get(column, 0) + value
+
+    def identify(self, docname, content_id):
+        """
+        Note the content ID of the envelope produced from a document.
+        """
+
+        with self._lock:
+            self.documents.setdefault(docname, {})['content_id'] = content_id
+
+    def describe(self, docname, envelope, body_size):
+        """
+        Record the content ID, body size and image count of a document's
+        envelope.
+        """
+
+        self.identify(docname, envelope.content_id)
+        self.record(docname, 'body_size', body_size)
+        offsets = envelope.asset_offsets or {}
+        self.record(docname, 'images', sum(len(positions) for positions in offsets.values()))
+
+    def record_envelope(self, content_id, column, value):
+        """
+        Add a value to one column of the row for the document that produced an
+        envelope.
+        """
+
+        with self._lock:
+            row = self.envelopes.setdefault(content_id, {})
+            row[column] = row.get(column, 0) + value
+
+    def connect(self, app):
+        """
+        Time the reading of each document. Read times are kept on the
+        environment, so that they survive the merge of environments read by
+        parallel worker processes.
+        """
+
+        def before_read(app, env, docnames):
+            env.deconst_read_times = {}
+
+        def source_read(app, docname, source):
+            app.env.temp_data['deconst_read_started'] = time.perf_counter()
+
+        def doctree_read(app, doctree):
+            started = app.env.temp_data.get('deconst_read_started')
+            if started is not None:
+                app.env.deconst_read_times[app.env.docname] = time.perf_counter() - started
+
+        def merge_info(app, env, docnames, other):
+            env.deconst_read_times.update(getattr(other, 'deconst_read_times', {}))
+
+        app.connect('env-before-read-docs', before_read)
+        app.connect('source-read', source_read)
+        app.connect('doctree-read', doctree_read)
+        app.connect('env-merge-info', merge_info)
+
+    def collect_reads(self, env):
+        """
+        Gather the read times recorded on the environment during this build.
+        """
+
+        for docname, seconds in getattr(env, 'deconst_read_times', {}).items():
+            self.record(docname, 'read', seconds)
+
+    def snapshot(self):
+        """
+        Copy everything recorded so far.
+        """
+
+        with self._lock:
+            return ({docname: dict(row) for docname, row in self.documents.items()},
+                    {content_id: dict(row) for content_id, row in self.envelopes.items()})
+
+    def merge(self, snapshot):
+        """
+        Add everything recorded by another profile, such as one in a worker
+        process.
+        """
+
+        documents, envelopes = snapshot
+        for docname, row in documents.items():
+            for column, value in row.items():
+                if column == 'content_id':
+                    self.identify(docname, value)
+                else:
+                    self.record(docname, column, value)
+        for content_id, row in envelopes.items():
+            for column, value in row.items():
+                self.record_envelope(content_id, column, value)
+
+    def reset(self):
+        with self._lock:
+            self.documents = {}
+            self.envelopes = {}
+
+    def rows(self):
+        """
+        Assemble one row per document, slowest first.
+        """
+
+        documents, envelopes = self.snapshot()
+
+        rows = []
+        for docname, row in documents.items():
+            row = dict(row, docname=docname)
+            row.update(envelopes.get(row.get('content_id'), {}))
+            for column in TIME_COLUMNS + ('body_size', 'images'):
+                row.setdefault(column, 0)
+            row['total'] = sum(row[column] for column in TIME_COLUMNS)
+            rows.append(row)
+
+        rows.sort(key=lambda row: (-row['total'], row['docname']))
+        return rows
+
+    def summary(self, top):
+        """
+        Describe the "top" slowest and largest documents.
+        """
+
+        rows = self.rows()
+
+        lines = ['slowest documents:']
+        for row in rows[:top]:
+            lines.append('  {:8.3f}s  {} (read {:.3f}s, translate {:.3f}s, serialize {:.3f}s)'.format(
+                row['total'], row['docname'], row['read'], row['translate'], row['serialize']))
+
+        lines.append('largest documents:')
+        for row in sorted(rows, key=lambda row: (-row['body_size'], row['docname']))[:top]:
+            lines.append('  {:8d}  {} ({} images)'.format(row['body_size'], row['docname'], row['images']))
+
+        return lines
+
+    def write(self, filename):
+        """
+        Write the full table as JSON.
+        """
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.rows(), f, indent=2, sort_keys=True)
@@ -1,18 +1,36 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
+import os
+import time
 import urllib.parse
+from os import path
 
+import sphinx
 from docutils import nodes
 from sphinx import addnodes
-from sphinx.builders.html import JSONHTMLBuilder
+from sphinx.builders.html import JSONHTMLBuilder, get_stable_hash
 from sphinx.util import jsonimpl
+from sphinx.util.console import bold, darkgreen
 from sphinx.util.osutil import relative_uri
-from .common import init_builder, derive_content_id
-from .envelope import Envelope
+from sphinx.util.parallel import make_chunks
+from deconstrst.timing import timer
+from .parallel import ParallelTasks
+from .common import init_builder, cleanup_builder, derive_content_id
+from .envelope import Envelope, EnvelopeContext, serialization_path
 
 
 TOC_DOCNAME = '_toc'
 
+# The rendered TOC from the previous build is kept here, within the output
+# directory, along with the key that it was rendered from.
+TOC_CACHE_FILENAME = '.deconst-toc.json'
+
+# Each document's envelope is stamped as written by an empty file within the
+# output directory, named for the document with this suffix.
+WRITTEN_STAMP_SUFFIX = '.written'
+
 class DeconstSerialJSONBuilder(JSONHTMLBuilder):
     """
     Custom Sphinx builder that generates Deconst-compatible JSON documents.
@@ -26,19 +44,160 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
         super().init()
         init_builder(self)
 
+        self.envelope_context = EnvelopeContext(self.config, self.deconst_config)
+
         self.toc_envelope = None
 
+        # Within a worker process, envelopes are collected here and returned to
+        # the main process instead of being written directly.
+        self.deferred_envelopes = None
+
+        # The documents written by the current build, and when it started.
+        self.written_docnames = set()
+        self.build_started = None
+
+    def build(self, docnames, summary=None, method='update'):
+        """
+        Remove envelopes left behind by documents that were deleted since the
+        last incremental build.
+        """
+
+        previous_docnames = set(self.env.all_docs)
+        self.written_docnames = set()
+        self.build_started = time.time()
+
+        super().build(docnames, summary, method)
+
+        for docname in previous_docnames - self.env.found_docs:
+            try:
+                os.remove(self.get_outfilename(docname))
+            except FileNotFoundError:
+                pass
+
+            # The TOC envelope is regenerated in prepare_writing().
+            if docname == TOC_DOCNAME:
+                continue
+
+            content_id = derive_content_id(self.deconst_config, docname)
+            self.envelope_writer.remove(content_id, serialization_path(self.deconst_config, content_id))
+
+    def get_outdated_docs(self):
+        """
+        Consider every document to be outdated if _deconst.json has changed
+        since the last build. Otherwise, compare each source file against the
+        stamp left when its envelope was last written.
+        """
+
+        buildinfo = path.join(self.outdir, '.buildinfo')
+        if path.exists('_deconst.json') and path.exists(buildinfo) and \
+                path.getmtime('_deconst.json') > path.getmtime(buildinfo):
+            return self.env.found_docs
+
+        return super().get_outdated_docs()
+
+    def get_outfilename(self, pagename):
+        """
+        A stamp takes the place of the rendered output file, so that Sphinx
+        compares each source file against the time its envelope was last
+        written. The envelope itself can't be used: an envelope whose payload
+        is unchanged keeps its old mtime, and a streamed envelope has no file.
+        """
+
+        return path.join(self.outdir, pagename + WRITTEN_STAMP_SUFFIX)
+
+    @timer.timed('prepare_writing')
     def prepare_writing(self, docnames):
         """
         Emit the global TOC envelope for this content repository.
         """
 
         super().prepare_writing(docnames)
+        self.written_docnames = set(docnames)
 
         self.toc_envelope = self._toc_envelope()
         if self.toc_envelope:
-            self.dump_context(self.toc_envelope.serialization_payload(),
-                              self.toc_envelope.serialization_path())
+            self.envelope_writer.write_envelope(self.toc_envelope)
+
+    def write_doc(self, docname, doctree):
+        """
+        Time the translation of each document.
+        """
+
+        started = time.perf_counter()
+
+        with timer.phase('translate'):
+            super().write_doc(docname, doctree)
+
+        if self.document_profile:
+            self.document_profile.record(docname, 'translate', time.perf_counter() - started)
+
+    def write_doc_serialized(self, docname, doctree):
+        """
+        Publish referenced assets from the main process.
+        """
+
+        super().write_doc_serialized(docname, doctree)
+        self.asset_publisher.publish_images(doctree)
+
+    def _write_parallel(self, docnames, warnings, nproc):
+        """
+        Translate documents within worker processes, but serialize each
+        envelope from the main process as its chunk completes.
+        """
+
+        def write_process(docs):
+            local_warnings = []
+
+            def warnfunc(*args, **kwargs):
+                local_warnings.append((args, kwargs))
+            self.env.set_warnfunc(warnfunc)
+
+            # Report only the time spent within this worker.
+            timer.reset()
+            if self.document_profile:
+                self.document_profile.reset()
+
+            self.deferred_envelopes = []
+            for docname, doctree in docs:
+                self.write_doc(docname, doctree)
+
+            documents = None
+            if self.document_profile:
+                documents = self.document_profile.snapshot()
+            return local_warnings, self.deferred_envelopes, timer.snapshot(), documents
+
+        def write_envelopes(docs, result):
+            local_warnings, envelopes, phases, documents = result
+            warnings.extend(local_warnings)
+            timer.merge(phases)
+            if documents:
+                self.document_profile.merge(documents)
+            for content_id, payload, outfilename in envelopes:
+                self.envelope_writer.write(content_id, payload, outfilename)
+
+        # warm up caches/compile templates using the first document
+        firstname, docnames = docnames[0], docnames[1:]
+        doctree = self.env.get_and_resolve_doctree(firstname, self)
+        self.write_doc_serialized(firstname, doctree)
+        self.write_doc(firstname, doctree)
+
+        tasks = ParallelTasks(nproc)
+        chunks = make_chunks(docnames, nproc)
+
+        for chunk in self.app.status_iterator(
+                chunks, 'writing output... ', darkgreen, len(chunks)):
+            arg = []
+            for docname in chunk:
+                doctree = self.env.get_and_resolve_doctree(docname, self)
+                self.write_doc_serialized(docname, doctree)
+                arg.append((docname, doctree))
+            tasks.add_task(write_process, arg, write_envelopes)
+
+        self.info(bold('waiting for workers...'))
+        tasks.join()
+
+        for warning, kwargs in warnings:
+            self.warn(*warning, **kwargs)
 
     def handle_page(self, pagename, context, **kwargs):
         """
@@ -53,9 +212,43 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
         """
         We need to write images and static assets *first*.
 
-        Also, the search indices and so on aren't necessary.
+        Also, the search indices and so on aren't necessary. Only the build
+        info is kept, so that incremental builds notice configuration changes.
+        Full builds never call get_outdated_docs(), so compute the hashes that
+        it records here.
+        """
+
+        self.config_hash = get_stable_hash({name: self.config[name] for name, desc in self.config.values.items()
+                                            if desc[1] == 'html'})
+        self.tags_hash = get_stable_hash(sorted(self.tags))
+        self.write_buildinfo()
+
+    def cleanup(self):
+        """
+        Report what this build has produced.
+        """
+
+        super().cleanup()
+        cleanup_builder(self)
+        self._stamp_written()
+
+    def _stamp_written(self):
         """
+        Once every envelope of a build has been written, stamp each document
+        that it wrote with the time the build started, so that sources changed
+        while it ran are written again by the next build.
+        """
+
+        for docname in self.written_docnames:
+            stamp = self.get_outfilename(docname)
+            os.makedirs(path.dirname(stamp), exist_ok=True)
+            with open(stamp, 'w'):
+                pass
+            os.utime(stamp, (self.build_started, self.build_started))
 
+        self.written_docnames = set()
+
+    @timer.timed('write_context')
     def write_context(self, context):
         """
         Override the default serialization code to save a derived metadata
@@ -73,8 +266,7 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
                             body=context['body'],
                             title=context['title'],
                             toc=local_toc,
-                            builder=self,
-                            deconst_config=self.deconst_config,
+                            context=self.envelope_context,
                             per_page_meta=per_page_meta,
                             docwriter=self.docwriter)
 
@@ -89,9 +281,18 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
         if self.toc_envelope:
             envelope.add_addenda('repository_toc', self.toc_envelope.content_id)
 
-        self.dump_context(envelope.serialization_payload(),
-                          envelope.serialization_path())
+        if self.document_profile:
+            self.document_profile.describe(docname, envelope, len(context['body']))
+
+        if self.deferred_envelopes is not None:
+            self.deferred_envelopes.append((envelope.content_id,
+                                            envelope.serialization_payload(),
+                                            envelope.serialization_path()))
+            return
 
+        self.envelope_writer.write_envelope(envelope)
+
+    @timer.timed('toc')
     def _toc_envelope(self):
         """
         Generate an envelope containing the TOC for this content repository.
@@ -105,6 +306,9 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
         expressions. At page presentation time, these are replaced with the
         presented URL of the named envelope based on that envelope's current
         mapping.
+
+        The rendered TOC is cached in the output directory, and rendered again
+        only when the toctree structure or titles that it depends on change.
         """
 
         if '_toc' in self.env.found_docs:
@@ -116,6 +320,34 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
             full_render = False
             includehidden = True
 
+        toc_key = self._toc_key(docname, full_render)
+        cached = self._load_toc_cache(toc_key)
+        if cached is None:
+            cached = self._render_toc(docname, full_render, includehidden)
+            self._save_toc_cache(toc_key, cached)
+
+        if cached['body'] is None:
+            return None
+
+        for uri in cached['images']:
+            self.asset_publisher.publish(uri)
+
+        envelope = Envelope(docname=TOC_DOCNAME,
+                            body=cached['body'],
+                            title=None,
+                            toc=None,
+                            context=self.envelope_context,
+                            per_page_meta={'deconstunsearchable': True},
+                            docwriter=None)
+        envelope.asset_offsets = cached['asset_offsets']
+        return envelope
+
+    def _render_toc(self, docname, full_render, includehidden):
+        """
+        Resolve and render the TOC from the chosen document. Return its body,
+        asset offsets and the URIs of any images that it includes.
+        """
+
         doctree = self.env.get_doctree(docname)
 
         # Identify toctree nodes from the chosen document
@@ -150,7 +382,7 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
 
         # No toctree found.
         if not toctrees:
-            return None
+            return {'body': None, 'asset_offsets': None, 'images': []}
 
         # Consolidate multiple toctrees
         toctree = toctrees[0]
@@ -158,7 +390,10 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
             toctree.extend(t.children)
 
         # Render either the toctree alone, or the full doctree
+        images = []
         if full_render:
+            images = [node['uri'] for node in doctree.traverse(nodes.image)]
+
             self.secnumbers = self.env.toc_secnumbers.get(docname, {})
             self.fignumbers = self.env.toc_fignumbers.get(docname, {})
             self.imgpath = relative_uri(self.get_target_uri(docname), '_images')
@@ -170,11 +405,87 @@ class DeconstSerialJSONBuilder(JSONHTMLBuilder):
             # Include the wrapper <div> for consistent markup.
             rendered_toc = self.render_partial(toctree.parent)['body']
 
-        return Envelope(docname=TOC_DOCNAME,
-                        body=rendered_toc,
-                        title=None,
-                        toc=None,
-                        builder=self,
-                        deconst_config=self.deconst_config,
-                        per_page_meta={'deconstunsearchable': True},
-                        docwriter=self._publisher.writer)
+        return {
+            'body': rendered_toc,
+            'asset_offsets': self._publisher.writer.visitor.calculate_offsets(),
+            'images': images,
+        }
+
+    def _toc_key(self, docname, full_render):
+        """
+        Fingerprint everything that the rendered TOC depends on: the structure
+        and titles of every document reachable through toctrees from the
+        chosen document, the content of a fully rendered _toc document, and
+        the settings and templates used to render and link them.
+        """
+
+        key = hashlib.sha256()
+
+        def add(value):
+            key.update(str(value).encode('utf-8'))
+            key.update(b'\0')
+
+        add(sphinx.__version__)
+        add(self.deconst_config.content_id_base)
+        add(docname)
+        add(full_render)
+
+        # Configuration values that affect reading or HTML output, the tags in
+        # effect, and any templates.
+        add(get_stable_hash({name: self.config[name] for name, desc in self.config.values.items()
+                             if desc[1] in ('env', 'html')}))
+        add(get_stable_hash(sorted(self.tags)))
+        for templates_dir in self.config.templates_path:
+            for dirpath, dirnames, filenames in os.walk(path.join(self.confdir, templates_dir)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    template_path = path.join(dirpath, filename)
+                    add(template_path)
+                    add(os.stat(template_path).st_mtime_ns)
+
+        # A fully rendered _toc document depends on its entire contents.
+        if full_render:
+            add(self.env.get_doctree(docname).pformat())
+
+        seen = set()
+        pending = [docname]
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+
+            add(current)
+            toc = self.env.tocs.get(current)
+            add(toc.pformat() if toc is not None else None)
+            title = self.env.titles.get(current)
+            add(title.pformat() if title is not None else None)
+            add(sorted(self.env.toc_secnumbers.get(current, {}).items()))
+
+            pending.extend(reversed(self.env.toctree_includes.get(current, [])))
+
+        return key.hexdigest()
+
+    def _load_toc_cache(self, toc_key):
+        """
+        Return the TOC rendered by a previous build from the same key, if
+        there is one.
+        """
+
+        try:
+            with open(path.join(self.outdir, TOC_CACHE_FILENAME), 'r', encoding='utf-8') as cf:
+                cached = json.load(cf)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if cached.get('key') != toc_key:
+            return None
+        return cached
+
+    def _save_toc_cache(self, toc_key, rendered):
+        """
+        Keep a rendered TOC for the next build.
+        """
+
+        with open(path.join(self.outdir, TOC_CACHE_FILENAME), 'w', encoding='utf-8') as cf:
+            json.dump(dict(rendered, key=toc_key), cf)
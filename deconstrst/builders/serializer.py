@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoders for envelope payloads.
+
+Every serializer must produce exactly the same bytes as the standard library's
+json module, so that switching encoders never causes an unchanged envelope to
+be rewritten. Keys are sorted, because the order of a dict's keys varies from
+one process to the next on the Pythons that this runs on. Envelopes are encoded
+compactly, which every version of ujson does, since only recent ones accept
+separators.
+"""
+
+import uuid
+from json.encoder import encode_basestring_ascii
+
+from sphinx.util.jsonimpl import SphinxJSONEncoder
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class Serializer:
+    """
+    Encode payloads with the standard library's json module.
+    """
+
+    name = 'json'
+
+    def __init__(self):
+        self.encoder = SphinxJSONEncoder(sort_keys=True, separators=(',', ':'))
+
+    def dumps(self, payload):
+        """
+        Encode a payload as UTF-8 JSON bytes.
+        """
+
+        return self.encoder.encode(payload).encode('utf-8')
+
+    def iter_dumps(self, payload, body_chunks):
+        """
+        Encode a payload whose "body" is supplied separately, as an iterable of
+        string chunks. Yield the same bytes that dumps() would produce for the
+        payload with the joined body as its "body", a piece at a time.
+        """
+
+        # Encode the rest of the payload around a placeholder body, then
+        # replace the placeholder with the encoded chunks.
+        placeholder = uuid.uuid4().hex
+        head, tail = self.dumps(dict(payload, body=placeholder)).split(placeholder.encode('ascii'), 1)
+
+        yield head
+        for chunk in body_chunks:
+            yield encode_basestring_ascii(chunk)[1:-1].encode('ascii')
+        yield tail
+
+
+class UltraJSONSerializer(Serializer):
+    """
+    Encode payloads with ujson, which is faster than the standard library for
+    large bodies.
+
+    ujson formats floats and escapes DEL differently, and doesn't know about
+    Sphinx's translation proxies, so payloads that contain any of those are
+    passed to the standard library instead.
+    """
+
+    name = 'ujson'
+
+    def dumps(self, payload):
+        if not _plain(payload):
+            return super().dumps(payload)
+
+        return ujson.dumps(payload, ensure_ascii=True, escape_forward_slashes=False,
+                           sort_keys=True).encode('utf-8')
+
+    @classmethod
+    def available(cls):
+        """
+        Determine whether or not an ujson that can sort keys and leave forward
+        slashes alone is installed.
+        """
+
+        if ujson is None:
+            return False
+
+        try:
+            ujson.dumps({}, escape_forward_slashes=False, sort_keys=True)
+        except TypeError:
+            return False
+        return True
+
+
+SERIALIZERS = {
+    Serializer.name: Serializer,
+    UltraJSONSerializer.name: UltraJSONSerializer,
+}
+
+
+def get_serializer(name=None):
+    """
+    Construct the named serializer, or the fastest one available.
+    """
+
+    if name:
+        if name not in SERIALIZERS:
+            raise ValueError("Unknown JSON serializer [{}]. Choose one of: {}."
+                             .format(name, ', '.join(sorted(SERIALIZERS))))
+        if name == UltraJSONSerializer.name and not UltraJSONSerializer.available():
+            raise ValueError("The ujson serializer requires ujson 1.35 or later.")
+        return SERIALIZERS[name]()
+
+    if UltraJSONSerializer.available():
+        return UltraJSONSerializer()
+    return Serializer()
+
+
+def available_serializers():
+    """
+    Construct one of each serializer that can be used here.
+    """
+
+    serializers = [Serializer()]
+    if UltraJSONSerializer.available():
+        serializers.append(UltraJSONSerializer())
+    return serializers
+
+
+def _plain(value):
+    """
+    Determine whether or not a payload is made only of types that every
+    serializer encodes identically.
+    """
+
+    tp = type(value)
+
+    if tp is str:
+        return '\x7f' not in value
+    if tp is dict:
+        return all(type(k) is str and _plain(k) and _plain(v) for k, v in value.items())
+    if tp is list or tp is tuple:
+        return all(_plain(v) for v in value)
+    return value is None or tp is bool or tp is int
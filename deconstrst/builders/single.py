@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
 
 from docutils import nodes
 from sphinx.builders.html import SingleFileHTMLBuilder
-from sphinx.util import jsonimpl
-from .envelope import Envelope
-from .common import init_builder
+from sphinx.util.osutil import relative_uri
+from deconstrst.timing import timer
+from .envelope import Envelope, EnvelopeContext
+from .common import init_builder, cleanup_builder
 
 
 class DeconstSingleJSONBuilder(SingleFileHTMLBuilder):
@@ -20,6 +22,8 @@ class DeconstSingleJSONBuilder(SingleFileHTMLBuilder):
         super().init()
         init_builder(self)
 
+        self.envelope_context = EnvelopeContext(self.config, self.deconst_config)
+
     def fix_refuris(self, tree):
         """
         The parent implementation of this includes the base file name, which
@@ -42,6 +46,53 @@ class DeconstSingleJSONBuilder(SingleFileHTMLBuilder):
 
             refnode['refuri'] = refuri[hashindex:]
 
+    @timer.timed('assemble')
+    def assemble_doctree(self):
+        return super().assemble_doctree()
+
+    def write_doc_serialized(self, docname, doctree):
+        """
+        Publish referenced assets before the assembled doctree is translated.
+        """
+
+        super().write_doc_serialized(docname, doctree)
+        self.asset_publisher.publish_images(doctree)
+
+    def write_doc(self, docname, doctree):
+        """
+        Translate the assembled doctree, but leave its body as the translator's
+        list of chunks rather than joining it into a single string. The chunks
+        are streamed into the envelope by write_context().
+
+        This avoids building the joined body and its JSON-encoded copy, but the
+        chunk list and the assembled doctree are still held until the envelope
+        is written: docutils rewrites earlier body chunks while translating and
+        asset offsets are only known once the body is complete. Peak memory
+        therefore remains proportional to the size of the manual.
+        """
+
+        doctree.settings = self.docsettings
+
+        self.secnumbers = self.env.toc_secnumbers.get(docname, {})
+        self.fignumbers = self.env.toc_fignumbers.get(docname, {})
+        self.imgpath = relative_uri(self.get_target_uri(docname), '_images')
+        self.dlpath = relative_uri(self.get_target_uri(docname), '_downloads')
+        self.current_docname = docname
+
+        started = time.perf_counter()
+
+        with timer.phase('translate'):
+            visitor = self.translator_class(self, doctree)
+            doctree.walkabout(visitor)
+
+        if self.document_profile:
+            self.document_profile.record(docname, 'translate', time.perf_counter() - started)
+
+        self.docwriter.visitor = visitor
+
+        ctx = self.get_doc_context(docname, visitor.fragment, ''.join(visitor.meta[2:]))
+        self.handle_page(docname, ctx, event_arg=doctree)
+
     def handle_page(self, pagename, context, **kwargs):
         """
         Override to call write_context.
@@ -61,9 +112,19 @@ class DeconstSingleJSONBuilder(SingleFileHTMLBuilder):
         Nothing to see here
         """
 
+    def cleanup(self):
+        """
+        Report what this build has produced.
+        """
+
+        super().cleanup()
+        cleanup_builder(self)
+
+    @timer.timed('write_context')
     def write_context(self, context):
         """
-        Write a derived metadata envelope to disk.
+        Write a derived metadata envelope to disk. Its body is the list of
+        chunks produced by write_doc().
         """
 
         docname = context['current_page_name']
@@ -77,10 +138,11 @@ class DeconstSingleJSONBuilder(SingleFileHTMLBuilder):
                             body=context['body'],
                             title=context['title'],
                             toc=local_toc,
-                            builder=self,
-                            deconst_config=self.deconst_config,
+                            context=self.envelope_context,
                             per_page_meta=per_page_meta,
                             docwriter=self.docwriter)
 
-        with open(envelope.serialization_path(), 'w', encoding="utf-8") as f:
-            jsonimpl.dump(envelope.serialization_payload(), f)
+        if self.document_profile:
+            self.document_profile.describe(docname, envelope, sum(map(len, context['body'])))
+
+        self.envelope_writer.write_streaming(envelope)
@@ -1,21 +1,30 @@
 # -*- coding: utf-8 -*-
 
-import shutil
 import re
-import os
-from os import path
 from collections import defaultdict
 
 from sphinx.writers.html import HTMLTranslator
+from .assets import resolve_asset
 
 # Regexp to match the source attribute of an <img> tag that's been generated
 # with a placeholder.
 RE_SRCATTR = re.compile(r"src\s*=\s*\"(X)\"")
 
+# The exact form of that attribute that HTMLTranslator.starttag() produces.
+PLACEHOLDER_SRCATTR = 'src="X"'
+
 class OffsetHTMLTranslator(HTMLTranslator):
     """
     Hook Sphinx's HTMLTranslator to track the offsets of image nodes within the
     rendered content.
+
+    Offsets are computed as each image is visited, by measuring only the body
+    chunks added since the previous image, so pages without images cost
+    nothing and each chunk is measured at most once. docutils never edits
+    earlier chunks in place, but it does move them out of the body when it
+    departs a document title, subtitle, docinfo, header or footer; the
+    measurement is re-anchored at those points and offsets within the moved
+    chunks are discarded.
     """
 
     def __init__(self, *args, **kwargs):
@@ -23,65 +32,91 @@ class OffsetHTMLTranslator(HTMLTranslator):
 
         self.asset_offsets = defaultdict(list)
 
-        dc = self.builder.deconst_config
-        self.asset_src_root = path.realpath('_images') # This is actually hardcoded in StandaloneHTMLBuilder
-        self.asset_dest_root = path.realpath(dc.asset_dir)
+        # The combined length of the first _measured_chunks chunks of the body.
+        self._measured_chunks = 0
+        self._measured_length = 0
 
     def visit_image(self, node):
         """
         Record the offset for this asset reference.
-        """
 
-        asset_src_path = path.realpath(node['uri'])
-        if asset_src_path.startswith(self.asset_src_root):
-            asset_rel_path = path.relpath(asset_src_path, self.asset_src_root)
-        else:
-            asset_rel_path = asset_src_path[1:]
-        asset_dest_path = path.join(self.asset_dest_root, asset_rel_path)
+        The asset itself is published by the builder before translation
+        begins, because translation may happen within a worker process.
+        """
 
-        os.makedirs(path.dirname(asset_dest_path), exist_ok=True)
-        shutil.copyfile(asset_src_path, asset_dest_path)
+        _, asset_rel_path, _ = resolve_asset(self.builder.deconst_config, node['uri'])
         node['uri'] = 'X'
 
         super().visit_image(node)
 
         chunk = self.body[-1]
-        chunk_match = RE_SRCATTR.search(chunk)
-        if not chunk_match:
-            msg = "Unable to find image tag placeholder src attribute within [{}]".format(self.body[-1])
-            raise Exception(msg)
+        chunk_offset = chunk.find(PLACEHOLDER_SRCATTR)
+        if chunk_offset >= 0:
+            chunk_offset += len(PLACEHOLDER_SRCATTR) - 2
+        else:
+            chunk_match = RE_SRCATTR.search(chunk)
+            if not chunk_match:
+                msg = "Unable to find image tag placeholder src attribute within [{}]".format(self.body[-1])
+                raise Exception(msg)
+            chunk_offset = chunk_match.start(1)
 
         chunk_index = len(self.body) - 1
-        chunk_offset = chunk_match.start(1)
+        self.asset_offsets[asset_rel_path].append(self._chunk_start(chunk_index) + chunk_offset)
 
-        self.asset_offsets[asset_rel_path].append(AssetOffset(chunk_index, chunk_offset))
+    def depart_title(self, node):
+        if self.in_document_title:
+            self._discard_from(0)
+        super().depart_title(node)
 
-    def calculate_offsets(self):
+    def depart_subtitle(self, node):
+        if self.in_document_title:
+            self._discard_from(0)
+        super().depart_subtitle(node)
+
+    def depart_docinfo(self, node):
+        self._discard_from(0)
+        super().depart_docinfo(node)
+
+    def depart_header(self, node):
+        self._discard_from(self.context[-1])
+        super().depart_header(node)
+
+    def depart_footer(self, node):
+        self._discard_from(self.context[-1])
+        super().depart_footer(node)
+
+    def _chunk_start(self, chunk_index):
         """
-        Use the final translator state to compute body offsets for all assets.
+        Compute the offset at which a body chunk begins, measuring only the
+        chunks that have been added since the last measurement.
         """
 
-        if not self.asset_offsets:
-            return {}
+        if chunk_index < self._measured_chunks:
+            self._measured_chunks, self._measured_length = 0, 0
 
-        total = 0
+        self._measured_length += sum(map(len, self.body[self._measured_chunks:chunk_index]))
+        self._measured_chunks = chunk_index
+        return self._measured_length
 
-        chunk_offsets = []
-        for chunk in self.body:
-            chunk_offsets.append(total)
-            total += len(chunk)
+    def _discard_from(self, chunk_index):
+        """
+        Re-anchor the measurement before docutils removes every body chunk
+        from chunk_index onward, and forget the offsets of images within them.
+        """
 
-        results = {}
-        for (asset_rel_path, asset_offsets) in self.asset_offsets.items():
-            offsets = [chunk_offsets[o.chunk_index] + o.chunk_offset for o in asset_offsets]
-            results[asset_rel_path] = offsets
-        return results
+        start = self._chunk_start(chunk_index)
 
-class AssetOffset:
-    """
-    Store the location of an asset URL reference within the document.
-    """
+        for asset_rel_path in list(self.asset_offsets):
+            offsets = [offset for offset in self.asset_offsets[asset_rel_path] if offset < start]
+            if offsets:
+                self.asset_offsets[asset_rel_path] = offsets
+            else:
+                del self.asset_offsets[asset_rel_path]
+
+    def calculate_offsets(self):
+        """
+        Report the body offsets recorded for each asset.
+        """
 
-    def __init__(self, chunk_index, chunk_offset):
-        self.chunk_index = chunk_index
-        self.chunk_offset = chunk_offset
+        return {asset_rel_path: list(offsets)
+                for asset_rel_path, offsets in self.asset_offsets.items()}
@@ -3,6 +3,14 @@
 import json
 import os
 from os import path
+from types import MappingProxyType
+
+# Configurations that have already been loaded, keyed by the environment and
+# the state of the _deconst.json file that they were derived from.
+_loaded = {}
+
+# Formats that OUTPUT_FORMAT may name.
+OUTPUT_FORMATS = ('ndjson', 'tar')
 
 
 def _normalize(url):
@@ -16,9 +24,32 @@ def _normalize(url):
         return url
 
 
+def _truthy(value):
+    """
+    Interpret a setting from the environment or _deconst.json as a boolean.
+    """
+
+    if isinstance(value, str):
+        return value.lower() in ("true", "yes", "1")
+    return bool(value)
+
+
+def _workers(value):
+    """
+    Interpret a worker count setting. "auto" uses one worker per CPU.
+    """
+
+    if value == "auto":
+        return os.cpu_count() or 1
+    return max(int(value), 1)
+
+
 class Configuration:
     """
     Configuration settings derived from the environment and current git branch.
+
+    Use load() to construct a configuration that's been completed from
+    _deconst.json. Loaded configurations are shared, so they're read-only.
     """
 
     def __init__(self, env):
@@ -36,15 +67,78 @@ class Configuration:
         if not self.asset_dir:
             self.asset_dir = path.join(self.content_root, '_build', 'deconst-assets')
 
+        # Reports about the build itself are written alongside the envelope
+        # directory.
+        self.report_dir = env.get("REPORT_DIR", None)
+        if not self.report_dir:
+            self.report_dir = path.dirname(path.abspath(self.envelope_dir))
+
+        self.timing_report = None
+        if _truthy(env.get("TIMING_REPORT", False)):
+            self.timing_report = path.join(self.report_dir, 'deconst-timing.json')
+
+        self.memory_report = None
+        if _truthy(env.get("MEMORY_REPORT", False)):
+            self.memory_report = path.join(self.report_dir, 'deconst-memory.json')
+
+        self.document_report = None
+        if _truthy(env.get("DOCUMENT_REPORT", False)):
+            self.document_report = path.join(self.report_dir, 'deconst-documents.json')
+        self.document_report_top = int(env.get("DOCUMENT_REPORT_TOP", None) or 10)
+
+        self.manifest_path = env.get("MANIFEST_PATH", None)
+        if not self.manifest_path:
+            self.manifest_path = path.join(self.content_root, '_build', 'deconst-manifest.json')
+
+        # Wheels built while installing a content repository's requirements are
+        # kept here, so that later builds don't need to build them again.
+        self.requirements_cache_dir = env.get("REQUIREMENTS_CACHE_DIR", None)
+        if not self.requirements_cache_dir:
+            self.requirements_cache_dir = path.join(self.content_root, '_build', 'deconst-pip-cache')
+
+        # Stream every envelope (and optionally every asset) into a single
+        # NDJSON or tar stream, instead of writing individual files.
+        self.output_stream = env.get("OUTPUT_STREAM", None)
+        self.output_format = env.get("OUTPUT_FORMAT", "ndjson")
+        self.output_assets = _truthy(env.get("OUTPUT_ASSETS", False))
+
+        # Name a specific JSON serializer for envelopes, rather than using the
+        # fastest one that's installed.
+        self.json_serializer = env.get("JSON_SERIALIZER", None)
+
+        self.incremental = None
+        if env.get("INCREMENTAL_BUILD"):
+            self.incremental = _truthy(env["INCREMENTAL_BUILD"])
+
+        # Seconds that the service lets a build run before stopping it.
+        self.build_timeout = float(env.get("BUILD_TIMEOUT", None) or 600)
+
+        self.workers = None
+        if env.get("PARALLEL_WORKERS"):
+            self.workers = _workers(env["PARALLEL_WORKERS"])
+
         self.meta = {}
         self.github_url = ""
         self.github_branch = "master"
 
         try:
-            self.git_root = self._get_git_root(os.getcwd())
+            self.git_root = self._get_git_root(path.realpath(self.content_root))
         except FileNotFoundError:
             self.git_root = None
 
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("Loaded configurations are read-only.")
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        """
+        Prevent any further changes to this configuration.
+        """
+
+        self.meta = MappingProxyType(self.meta)
+        self._frozen = True
+
     def apply_file(self, f):
         """
         Parse the contents of an open filehandle as JSON and apply recognized
@@ -71,6 +165,12 @@ class Configuration:
             self.github_issues_url = '/'.join(segment.strip('/') for segment in [doc["githubUrl"], 'issues'])
             self.meta.update({'github_issues_url': self.github_issues_url})
 
+        if "incremental" in doc and self.incremental is None:
+            self.incremental = _truthy(doc["incremental"])
+
+        if "workers" in doc and self.workers is None:
+            self.workers = _workers(doc["workers"])
+
         if "githubBranch" in doc:
             self.github_branch = doc["githubBranch"]
         else:
@@ -104,10 +204,53 @@ class Configuration:
 
         return reasons
 
+    def invalid_values(self):
+        """
+        Determine whether or not every setting that was given can be used. If
+        not, return a list of reasons why a build can't begin.
+        """
+
+        reasons = []
+
+        if self.output_format not in OUTPUT_FORMATS:
+            reasons.append("OUTPUT_FORMAT [{}] isn't a supported stream format. "
+                           "It should be one of: {}."
+                           .format(self.output_format, ', '.join(OUTPUT_FORMATS)))
+
+        return reasons
+
     @classmethod
     def load(cls, env):
         """
-        Derive the current configuration from the environment.
+        Derive the current configuration from the environment and from the
+        _deconst.json file at the content root, if there is one.
+
+        The same configuration is returned for as long as the environment and
+        _deconst.json remain unchanged, so repeated builds of a repository
+        don't parse _deconst.json or search for the git root again.
         """
 
-        return cls(env)
+        content_root = env.get("CONTENT_ROOT", None) or os.getcwd()
+        config_path = path.join(content_root, "_deconst.json")
+
+        try:
+            st = os.stat(config_path)
+            config_state = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            config_state = None
+
+        root = path.realpath(content_root)
+        key = (root, tuple(sorted(env.items())), config_state)
+        config = _loaded.get(key)
+        if config is None:
+            config = cls(env)
+            if config_state is not None:
+                with open(config_path, "r", encoding="utf-8") as cf:
+                    config.apply_file(cf)
+            config.freeze()
+
+            # Forget anything loaded for this content root before it changed.
+            for stale in [k for k in _loaded if k[0] == root]:
+                del _loaded[stale]
+            _loaded[key] = config
+        return config
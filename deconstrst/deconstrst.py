@@ -1,49 +1,162 @@
 # -*- coding: utf-8 -*-
 
+import ast
 import sys
 import os
 import urllib.parse
 
 import requests
+import sphinx.environment
+from deconstrst.builders.parallel import ParallelTasks
 from deconstrst.builders.serial import DeconstSerialJSONBuilder
 from deconstrst.builders.single import DeconstSingleJSONBuilder
+from deconstrst.timing import timer
 from sphinx.application import Sphinx
 from sphinx.builders import BUILTIN_BUILDERS
 
 DEFAULT_BUILDER = 'deconst-serial'
 
 
-def build(srcdir, destdir):
+def build(srcdir, destdir, incremental=False, parallel=1, builder=None,
+          deconst_config=None):
     """
     Invoke Sphinx with locked arguments to generate JSON content.
+
+    "builder" names the Sphinx builder to use. If it isn't given, it's read
+    from conf.py. "deconst_config" is the loaded Configuration to hand to the
+    builder.
+
+    When "incremental" is set, the pickled environment beneath destdir is
+    reused and only outdated documents are read and written again. A
+    "parallel" count above one reads and writes documents in that many
+    processes.
+    """
+
+    app = create_app(srcdir, destdir, incremental, parallel, builder, deconst_config)
+    app.build(not incremental, [])
+
+    return app.statuscode
+
+def create_app(srcdir, destdir, incremental=False, parallel=1, builder=None,
+               deconst_config=None):
+    """
+    Construct the Sphinx application used by build(), without building
+    anything yet.
     """
 
     # I am a terrible person
     BUILTIN_BUILDERS['deconst-serial'] = DeconstSerialJSONBuilder
     BUILTIN_BUILDERS['deconst-single'] = DeconstSingleJSONBuilder
+    sphinx.environment.ParallelTasks = ParallelTasks
 
-    conf_builder = get_conf_builder(srcdir)
+    conf_builder = builder or get_conf_builder(srcdir)
     doctreedir = os.path.join(destdir, '.doctrees')
 
-    app = Sphinx(srcdir=srcdir, confdir=srcdir, outdir=destdir,
-                 doctreedir=doctreedir, buildername=conf_builder,
-                 confoverrides={}, status=sys.stdout, warning=sys.stderr,
-                 freshenv=True, warningiserror=False, tags=[], verbosity=0,
-                 parallel=1)
-    app.build(True, [])
+    with timer.phase('setup'):
+        app = DeconstSphinx(deconst_config, srcdir=srcdir, confdir=srcdir, outdir=destdir,
+                            doctreedir=doctreedir, buildername=conf_builder,
+                            confoverrides={}, status=sys.stdout, warning=sys.stderr,
+                            freshenv=not incremental, warningiserror=False, tags=[], verbosity=0,
+                            parallel=parallel)
 
-    return app.statuscode
+    app.connect('env-before-read-docs', lambda app, env, docnames: timer.start('read'))
+    app.connect('env-updated', lambda app, env: timer.stop('read'))
+
+    return app
+
+class DeconstSphinx(Sphinx):
+    """
+    A Sphinx application that carries the deconst configuration, so that it's
+    available to the builder as soon as the builder is constructed.
+    """
+
+    def __init__(self, deconst_config, *args, **kwargs):
+        self.deconst_config = deconst_config
+        super().__init__(*args, **kwargs)
 
 def get_conf_builder(srcdir):
-    with open(os.path.join(srcdir, 'conf.py'), encoding="utf-8") as conf_file:
+    """
+    Determine the builder named by the "builder" variable in conf.py.
+
+    conf.py is parsed rather than executed, because Sphinx executes it again
+    anyway and a conf.py that imports extensions can be slow to run. Unless
+    "builder" is bound exactly once, by a top-level assignment of a string
+    literal, conf.py is executed instead.
+    """
+
+    conf_path = os.path.join(srcdir, 'conf.py')
+    with open(conf_path, encoding="utf-8") as conf_file:
         conf_data = conf_file.read()
 
     try:
-        code = compile(conf_data, 'conf.py', 'exec')
-        exec(code)
+        tree = ast.parse(conf_data, 'conf.py')
     except SyntaxError:
         """
         We'll just pretend nothing happened and use the default builder
         """
+        return DEFAULT_BUILDER
+
+    bindings = _builder_bindings(tree)
+    if not bindings:
+        return DEFAULT_BUILDER
+
+    # Trust the parse only for a single top-level "builder = '...'".
+    if len(bindings) == 1:
+        node = bindings[0]
+        if node in tree.body and isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                isinstance(node.targets[0], ast.Name):
+            try:
+                value = ast.literal_eval(node.value)
+            except ValueError:
+                value = None
+            if isinstance(value, str):
+                return value
+
+    return _exec_conf_builder(conf_path, conf_data)
+
+def _builder_bindings(tree):
+    """
+    Find every statement anywhere in a parsed conf.py that might bind the
+    name "builder".
+    """
+
+    def binds(target):
+        return any(isinstance(n, ast.Name) and n.id == 'builder' for n in ast.walk(target))
+
+    bindings = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            found = any(binds(target) for target in node.targets)
+        elif isinstance(node, (ast.AugAssign, ast.For, ast.comprehension)) or \
+                type(node).__name__ in ('AnnAssign', 'AsyncFor'):
+            found = binds(node.target)
+        elif isinstance(node, ast.withitem):
+            found = node.optional_vars is not None and binds(node.optional_vars)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            found = any(alias.name == '*' or (alias.asname or alias.name.split('.')[0]) == 'builder'
+                        for alias in node.names)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.ExceptHandler)) or \
+                type(node).__name__ == 'AsyncFunctionDef':
+            found = node.name == 'builder'
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            found = 'builder' in node.names
+        else:
+            found = type(node).__name__ == 'NamedExpr' and binds(node.target)
+
+        if found:
+            bindings.append(node)
+    return bindings
+
+def _exec_conf_builder(conf_path, conf_data):
+    """
+    Execute conf.py to find the value of a computed "builder" variable. Use the
+    default builder if it doesn't name one.
+    """
+
+    namespace = {'__file__': os.path.abspath(conf_path)}
+    exec(compile(conf_data, 'conf.py', 'exec'), namespace)
 
-    return locals().get('builder', DEFAULT_BUILDER)
+    builder = namespace.get('builder')
+    if not isinstance(builder, str) or not builder:
+        return DEFAULT_BUILDER
+    return builder
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in tracing of the memory allocated during each phase of a build.
+"""
+
+import json
+import threading
+import tracemalloc
+
+# Number of frames recorded for each allocation. Sites are reported by line.
+TRACEBACK_FRAMES = 1
+
+# Number of allocation sites reported for each phase.
+TOP_SITES = 10
+
+
+class MemoryTracker:
+    """
+    Record the memory traced by tracemalloc when each phase of a build ends.
+
+    tracemalloc can't reset its peak before Python 3.9, and phases overlap
+    when envelopes are serialized on background threads, so rather than a
+    peak within each phase, each phase reports the high-water mark of the
+    build when it ended and how far it raised that mark. The allocation sites
+    of a phase are those still holding memory at the end of the call that
+    raised the mark the furthest.
+    """
+
+    def __init__(self, top=TOP_SITES):
+        self.top = top
+        self.phases = {}
+
+        self._largest_increases = {}
+        self._started_tracing = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Begin tracing allocations, unless something else already is.
+        """
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEBACK_FRAMES)
+            self._started_tracing = True
+
+    def stop(self):
+        """
+        Stop tracing allocations if start() began it.
+        """
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def enter(self):
+        """
+        Note the traced memory at the start of a phase. Pass the result to
+        exit() at its end.
+        """
+
+        return tracemalloc.get_traced_memory()
+
+    def exit(self, name, entered):
+        """
+        Record the traced memory at the end of a phase.
+        """
+
+        if not tracemalloc.is_tracing():
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        entered_current, entered_peak = entered
+        increase = peak - entered_peak
+
+        with self._lock:
+            phase = self.phases.setdefault(name, {
+                'calls': 0,
+                'current': 0,
+                'retained': 0,
+                'peak': 0,
+                'peak_increase': 0,
+                'sites': [],
+            })
+            phase['calls'] += 1
+            phase['current'] = current
+            phase['retained'] += current - entered_current
+            phase['peak'] = max(phase['peak'], peak)
+            phase['peak_increase'] += increase
+
+            largest = increase > self._largest_increases.get(name, 0)
+            if largest:
+                self._largest_increases[name] = increase
+
+        if largest:
+            sites = self.sites()
+            with self._lock:
+                phase['sites'] = sites
+
+    def sites(self):
+        """
+        List the lines that hold the most traced memory right now.
+        """
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+        return [{
+            'site': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+            'size': stat.size,
+            'count': stat.count,
+        } for stat in snapshot.statistics('lineno')[:self.top]]
+
+    def write(self, filename):
+        """
+        Write the recorded phases, the build's high-water mark and the sites
+        holding the most memory at the end of the build as JSON.
+        """
+
+        current, peak = tracemalloc.get_traced_memory()
+        report = {'current': current, 'peak': peak, 'sites': self.sites()}
+
+        with self._lock:
+            report['phases'] = {name: dict(phase) for name, phase in self.phases.items()}
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
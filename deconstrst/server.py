@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+A long-running preparer that builds content on request, so that builds don't
+pay to start an interpreter and import Sphinx, docutils and Pygments.
+
+Requests are made over HTTP, on either a Unix socket or a port bound to the
+loopback interface:
+
+    POST /build
+    {"contentRoot": "/abs/path", "envelopeDir": "/abs/path", "assetDir": "/abs/path",
+     "contentIDBase": "https://github.com/org/repo/", "environment": {"INCREMENTAL_BUILD": "true"}}
+
+Each build runs in a child process forked from the service, so that it starts
+with everything the service has imported and loaded, but can't disturb the
+service or the builds that follow it.
+"""
+
+import http.client
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from os import path
+
+from deconstrst import main
+from deconstrst.config import Configuration
+from deconstrst.timing import timer
+
+# Members of a build request that name paths or settings, and the environment
+# variables that they're passed to the build as.
+REQUEST_SETTINGS = {
+    'contentRoot': 'CONTENT_ROOT',
+    'envelopeDir': 'ENVELOPE_DIR',
+    'assetDir': 'ASSET_DIR',
+    'contentIDBase': 'CONTENT_ID_BASE',
+}
+
+# Members of a build request that must be absolute paths, if they're given.
+REQUEST_PATHS = ('contentRoot', 'envelopeDir', 'assetDir')
+
+
+def parse_address(address):
+    """
+    Interpret an address given as "unix:/path/to/socket", "/path/to/socket" or
+    a port number. Return a socket family and the address to bind to within it.
+    Ports are only ever bound on the loopback interface.
+    """
+
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    if os.sep in address:
+        return socket.AF_UNIX, address
+
+    try:
+        port = int(address)
+    except ValueError:
+        raise ValueError("Unable to understand the address [{}]. Use a port number or unix:PATH."
+                         .format(address))
+    return socket.AF_INET, ('127.0.0.1', port)
+
+
+def request_environment(request, base_env=os.environ):
+    """
+    Derive the environment of a build from a build request. Raise ValueError if
+    the request can't be built.
+    """
+
+    if not isinstance(request, dict):
+        raise ValueError("A build request must be a JSON object.")
+    if not request.get('contentRoot'):
+        raise ValueError("A build request must include contentRoot.")
+
+    env = dict(base_env)
+    for key, value in request.items():
+        if key == 'environment':
+            continue
+        if key not in REQUEST_SETTINGS:
+            raise ValueError("Unknown build request member [{}].".format(key))
+        if not isinstance(value, str):
+            raise ValueError("{} must be a string.".format(key))
+        if key in REQUEST_PATHS and not path.isabs(value):
+            raise ValueError("{} must be an absolute path.".format(key))
+        env[REQUEST_SETTINGS[key]] = value
+
+    environment = request.get('environment', {})
+    if not isinstance(environment, dict) or \
+            not all(isinstance(v, str) for v in environment.values()):
+        raise ValueError("environment must be an object with string values.")
+    env.update(environment)
+
+    if env.get('OUTPUT_STREAM') == '-':
+        raise ValueError("Envelopes can't be streamed to the service's stdout.")
+    if not path.isdir(env['CONTENT_ROOT']):
+        raise ValueError("The content root [{}] isn't a directory.".format(env['CONTENT_ROOT']))
+
+    return env
+
+
+def run_build(env):
+    """
+    Build with "env" as the environment, in a child process. Return the
+    build's exit status, how long it took in total and in each phase, and
+    everything it printed. A build that runs for longer than BUILD_TIMEOUT
+    seconds is stopped and reported as failed.
+    """
+
+    started = time.perf_counter()
+
+    # Loaded here, the configuration is inherited by the child and cached for
+    # later requests to build the same content.
+    try:
+        deconst_config = Configuration.load(env)
+    except Exception:
+        return {'status': 1, 'seconds': time.perf_counter() - started, 'phases': {},
+                'output': traceback.format_exc()}
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=_build_child, args=(env, sender))
+    child.start()
+    sender.close()
+
+    timeout = deconst_config.build_timeout
+    deadline = started + timeout
+    result = None
+    try:
+        if receiver.poll(max(deadline - time.perf_counter(), 0)):
+            result = receiver.recv()
+    except EOFError:
+        pass
+    finally:
+        receiver.close()
+
+    child.join(max(deadline - time.perf_counter(), 0))
+    if child.is_alive():
+        child.terminate()
+        child.join()
+        if result is None:
+            result = {'status': 1, 'phases': {},
+                      'output': "The build was stopped after {:g}s. Set BUILD_TIMEOUT to allow longer builds.\n"
+                                .format(timeout)}
+
+    if result is None:
+        result = {'status': child.exitcode or 1, 'phases': {},
+                  'output': "The build process exited unexpectedly.\n"}
+
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def _build_child(env, sender):
+    os.environ.clear()
+    os.environ.update(env)
+
+    capture = io.StringIO()
+    status = 0
+    with redirect_stdout(capture), redirect_stderr(capture):
+        try:
+            main(timing=True)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print(e.code)
+                status = 1
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+
+    sender.send({'status': status, 'phases': timer.snapshot(), 'output': capture.getvalue()})
+    sender.close()
+
+
+class BuildRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer build requests and health checks.
+    """
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._respond(200, {'ok': True})
+        else:
+            self._respond(404, {'error': 'Not found.'})
+
+    def do_POST(self):
+        if self.path != '/build':
+            self._respond(404, {'error': 'Not found.'})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            env = request_environment(request)
+        except ValueError as e:
+            self._respond(400, {'error': str(e)})
+            return
+
+        self.log_message('building %s', env['CONTENT_ROOT'])
+        result = run_build(env)
+        self.log_message('built %s with status %s in %.2fs',
+                         env['CONTENT_ROOT'], result['status'], result['seconds'])
+        self._respond(200, result)
+
+    def _respond(self, code, doc):
+        data = json.dumps(doc).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address.
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """
+    An HTTP server listening on a Unix socket.
+    """
+
+    def server_bind(self):
+        # Replace a socket left behind by a service that didn't shut down.
+        if path.exists(self.server_address) and not path.isdir(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def serve(address):
+    """
+    Answer build requests at "address" until interrupted. Builds are run one at
+    a time.
+    """
+
+    family, bind_address = parse_address(address)
+    if family == socket.AF_UNIX:
+        server = UnixHTTPServer(bind_address, BuildRequestHandler)
+    else:
+        server = http.server.HTTPServer(bind_address, BuildRequestHandler)
+
+    print("Listening for build requests at {}.".format(address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    An HTTP connection over a Unix socket.
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    """
+    Send requests to a preparer service running at "address".
+    """
+
+    def __init__(self, address, timeout=None):
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+
+    def build(self, content_root, envelope_dir=None, asset_dir=None, content_id_base=None,
+              environment=None):
+        """
+        Build the content at "content_root". Return the build's exit status,
+        timing and output. Raise RuntimeError if the request is refused.
+        """
+
+        request = {'contentRoot': content_root}
+        if envelope_dir:
+            request['envelopeDir'] = envelope_dir
+        if asset_dir:
+            request['assetDir'] = asset_dir
+        if content_id_base:
+            request['contentIDBase'] = content_id_base
+        if environment:
+            request['environment'] = environment
+
+        return self._request('POST', '/build', request)
+
+    def health(self):
+        """
+        Determine whether or not the service is answering requests.
+        """
+
+        try:
+            return self._request('GET', '/health').get('ok', False)
+        except (OSError, RuntimeError, http.client.HTTPException):
+            return False
+
+    def _request(self, method, url, doc=None):
+        if self.family == socket.AF_UNIX:
+            conn = UnixHTTPConnection(self.address, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(*self.address, timeout=self.timeout)
+
+        try:
+            body = None
+            headers = {}
+            if doc is not None:
+                body = json.dumps(doc).encode('utf-8')
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, url, body, headers)
+
+            response = conn.getresponse()
+            result = json.loads(response.read().decode('utf-8'))
+        finally:
+            conn.close()
+
+        if response.status != 200:
+            raise RuntimeError(result.get('error', 'The service answered {}.'.format(response.status)))
+        return result
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in measurement of the time spent in each phase of a build.
+"""
+
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PhaseTimer:
+    """
+    Accumulate the time spent within, and the number of calls to, each named
+    phase of a build. Nothing is recorded until the timer is enabled.
+
+    Phases may be entered from several threads at once, in which case their
+    times are summed.
+
+    When "memory" is set to a MemoryTracker, the memory traced at the end of
+    each phase is recorded by it as well.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.memory = None
+
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        """
+        Forget everything recorded so far.
+        """
+
+        with self._lock:
+            self.phases = {}
+            self._started = {}
+
+    def record(self, name, seconds, calls=1):
+        """
+        Add time spent within a phase.
+        """
+
+        with self._lock:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            phase['seconds'] += seconds
+            phase['calls'] += calls
+
+    def merge(self, phases):
+        """
+        Add the phases recorded by another timer, such as one in a worker
+        process.
+        """
+
+        for name, phase in phases.items():
+            self.record(name, phase['seconds'], phase['calls'])
+
+    def start(self, name):
+        """
+        Begin a phase that will be ended by a call to stop().
+        """
+
+        if self.enabled:
+            self._started[name] = (time.perf_counter(), self._enter_memory())
+
+    def stop(self, name):
+        """
+        End a phase begun by start().
+        """
+
+        started = self._started.pop(name, None)
+        if started is not None:
+            started, memory = started
+            self.record(name, time.perf_counter() - started)
+            self._exit_memory(name, memory)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the body of a "with" statement as a phase.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        started = time.perf_counter()
+        memory = self._enter_memory()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+            self._exit_memory(name, memory)
+
+    def _enter_memory(self):
+        if self.memory is not None:
+            return self.memory.enter()
+
+    def _exit_memory(self, name, entered):
+        if self.memory is not None and entered is not None:
+            self.memory.exit(name, entered)
+
+    def timed(self, name):
+        """
+        Decorate a function so that each call is timed as a phase.
+        """
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.phase(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """
+        Copy the phases recorded so far.
+        """
+
+        with self._lock:
+            return {name: dict(phase) for name, phase in self.phases.items()}
+
+    def write(self, filename, total):
+        """
+        Write the recorded phases and the total build time as JSON.
+        """
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'total': total, 'phases': self.snapshot()}, f, indent=2, sort_keys=True)
+
+
+# The timer shared by everything within this process.
+timer = PhaseTimer()
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+Rebuild content each time it changes, keeping the Sphinx application and its
+environment in memory between builds.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+import traceback
+from os import path
+
+from deconstrst.builders.common import close_outputs, open_outputs
+from deconstrst.config import Configuration
+from deconstrst.deconstrst import create_app, get_conf_builder
+
+# Seconds between scans of the content root when inotify isn't available.
+POLL_INTERVAL = 1.0
+
+# Seconds to wait for further changes after the first, so that a burst of
+# saves leads to a single rebuild.
+SETTLE_TIME = 0.1
+
+# From <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event, without its variable-length name.
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Wait for changes beneath a directory with Linux's inotify.
+    """
+
+    def __init__(self, root, ignored):
+        self.ignored = ignored
+        self.watches = {}
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        try:
+            self._watch_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _watch_tree(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not self.ignored(path.join(dirpath, d))]
+
+            wd = self._inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e == errno.ENOENT:
+                    continue
+                raise OSError(e, os.strerror(e), dirpath)
+            self.watches[wd] = dirpath
+
+    def _read(self):
+        """
+        Read the events that are waiting. Return the paths they concern.
+        """
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            dirpath = self.watches.get(wd)
+            if dirpath is None:
+                continue
+
+            fullpath = path.join(dirpath, name)
+            if self.ignored(fullpath):
+                continue
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(fullpath)
+            changed.add(fullpath)
+
+        return changed
+
+    def wait(self):
+        """
+        Block until something changes. Return the paths that changed and when
+        the first change was noticed.
+        """
+
+        changed = set()
+        while not changed:
+            select.select([self.fd], [], [])
+            noticed = time.perf_counter()
+            changed |= self._read()
+
+        while select.select([self.fd], [], [], SETTLE_TIME)[0]:
+            changed |= self._read()
+
+        return changed, noticed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Wait for changes beneath a directory by comparing the modification time
+    and size of every file within it every POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, root, ignored):
+        self.root = root
+        self.ignored = ignored
+        self.files = self._scan()
+
+    def _scan(self):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not self.ignored(path.join(dirpath, d))]
+
+            for filename in filenames:
+                fullpath = path.join(dirpath, filename)
+                if self.ignored(fullpath):
+                    continue
+                try:
+                    st = os.stat(fullpath)
+                except FileNotFoundError:
+                    continue
+                files[fullpath] = (st.st_mtime_ns, st.st_size)
+        return files
+
+    def wait(self):
+        """
+        Block until something changes. Return the paths that changed and when
+        the change was noticed.
+        """
+
+        while True:
+            time.sleep(POLL_INTERVAL)
+
+            files = self._scan()
+            changed = {p for p in files.keys() | self.files.keys() if files.get(p) != self.files.get(p)}
+            self.files = files
+
+            if changed:
+                return changed, time.perf_counter()
+
+    def close(self):
+        pass
+
+
+def open_watcher(root, ignored):
+    """
+    Watch "root" with inotify if possible, or by polling otherwise. Paths for
+    which "ignored" returns True aren't watched.
+    """
+
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, ignored)
+        except (OSError, AttributeError) as e:
+            print("Unable to use inotify ({}). Polling for changes instead.".format(e), file=sys.stderr)
+
+    return PollingWatcher(root, ignored)
+
+
+def ignore_outputs(root, deconst_config):
+    """
+    Build a predicate that's True for the preparer's own output, and for hidden
+    files such as version control metadata and editor swap files, so that
+    writing them doesn't set off another build.
+    """
+
+    outputs = [path.join(root, '_build'), deconst_config.envelope_dir, deconst_config.asset_dir,
+               deconst_config.manifest_path, deconst_config.requirements_cache_dir,
+               deconst_config.timing_report, deconst_config.memory_report,
+               deconst_config.document_report]
+    outputs = [path.realpath(p) for p in outputs if p]
+
+    def ignored(p):
+        if path.basename(p).startswith('.') or p.endswith('~'):
+            return True
+
+        p = path.realpath(p)
+        return any(p == output or p.startswith(output + os.sep) for output in outputs)
+
+    return ignored
+
+
+def watch_and_rebuild(srcdir, deconst_config):
+    """
+    Build the content in "srcdir", then build it again each time it changes
+    until interrupted.
+
+    The Sphinx application is kept between builds, so that each rebuild only
+    reads and writes the documents affected by a change. It's constructed
+    again when conf.py changes, and when _deconst.json changes, after the
+    configuration has been loaded again.
+    """
+
+    if deconst_config.output_stream:
+        print("Watch mode writes envelopes to ENVELOPE_DIR. Unset OUTPUT_STREAM to use it.",
+              file=sys.stderr)
+        sys.exit(1)
+
+    root = path.abspath(srcdir)
+    conf_path = path.join(root, 'conf.py')
+    deconst_path = path.join(root, '_deconst.json')
+
+    watcher = open_watcher(root, ignore_outputs(root, deconst_config))
+
+    try:
+        started = time.perf_counter()
+        app = _build(None, srcdir, deconst_config, bool(deconst_config.incremental),
+                     prune=not deconst_config.incremental)
+        if app is None:
+            print("Build failed after {:.2f}s.".format(time.perf_counter() - started))
+
+        print("Watching {} for changes. Press Ctrl-C to stop.".format(root))
+
+        # Envelopes that a build doesn't produce are only removed once every
+        # document has been written again since _deconst.json changed.
+        prune = False
+
+        while True:
+            changed, noticed = watcher.wait()
+
+            if deconst_path in changed:
+                try:
+                    reloaded = Configuration.load(os.environ)
+                except Exception:
+                    traceback.print_exc()
+                    print("Not rebuilding until _deconst.json can be read.")
+                    continue
+
+                reasons = reloaded.invalid_values() + reloaded.missing_values()
+                if reasons:
+                    print("Not rebuilding because:")
+                    for reason in reasons:
+                        print(" * " + reason)
+                    continue
+
+                deconst_config = reloaded
+                app, prune = None, True
+            elif conf_path in changed:
+                app = None
+
+            app = _build(app, srcdir, deconst_config, True, prune)
+            if app is None:
+                print("Rebuild failed after {:.2f}s.".format(time.perf_counter() - noticed))
+                continue
+
+            prune = False
+            print("Rebuilt {} in {:.2f}s.".format(_describe(changed, root), time.perf_counter() - noticed))
+    except KeyboardInterrupt:
+        print("Stopped watching {}.".format(root))
+    finally:
+        watcher.close()
+
+
+def _build(app, srcdir, deconst_config, incremental, prune):
+    """
+    Build with "app", or with a new application if "app" is None. Return the
+    application to use for the next build, or None if this one failed.
+    """
+
+    builder, succeeded = None, False
+    try:
+        if app is None:
+            app = _create_app(srcdir, deconst_config, incremental)
+
+            # An unchanged configuration rebuilds nothing, so leave the
+            # envelopes of the previous build in place unless asked not to.
+            app.builder.prune_stale_envelopes = prune
+        else:
+            open_outputs(app.builder, prune=False)
+
+        builder = app.builder
+        app.build(not incremental, [])
+        succeeded = True
+        return app
+    except Exception:
+        traceback.print_exc()
+
+        # The application and its environment may be half updated. Start
+        # again from the pickled environment on the next change.
+        return None
+    finally:
+        # Sphinx only cleans the builder up after a successful build.
+        if builder is not None and not succeeded:
+            try:
+                close_outputs(builder)
+            except Exception:
+                traceback.print_exc()
+
+
+def _create_app(srcdir, deconst_config, incremental):
+    conf_builder = get_conf_builder(srcdir)
+    destdir = path.join('_build', conf_builder)
+
+    return create_app(srcdir, destdir,
+                      incremental=bool(incremental),
+                      parallel=deconst_config.workers or 1,
+                      builder=conf_builder,
+                      deconst_config=deconst_config)
+
+
+def _describe(changed, root):
+    names = sorted(path.relpath(p, root) for p in changed)
+    if len(names) > 3:
+        return '{} and {} other changes'.format(', '.join(names[:3]), len(names) - 3)
+    return ', '.join(names)
@@ -1,37 +1,58 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
+import base64
+import functools
+import hashlib
 import json
+import multiprocessing
 import os
 import io
+import re
+import signal
+import subprocess
 import sys
+import tarfile
+import tempfile
+import time
 import traceback
-from diff import diff
+import urllib.parse
+from diff import diff, diff_documents
 from os import path
-from shutil import rmtree
-from contextlib import redirect_stdout, redirect_stderr
+from shutil import copytree, ignore_patterns, rmtree
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 from termcolor import colored, cprint
 
 sys.path.append(path.join(path.dirname(__file__), '..'))
 
 import deconstrst
+from deconstrst.builders.serializer import SERIALIZERS, available_serializers
+from deconstrst.deconstrst import get_conf_builder
+from deconstrst.server import Client
 
 TESTCASE_ROOT = path.realpath(path.dirname(__file__))
 
-# Potential outcomes
+# The summary that builders print of the envelopes that they've handled.
+ENVELOPE_SUMMARY = re.compile(r'(\d+) written, (\d+) unchanged, (\d+) removed')
 
-PENDING = object()
-OK = object()
-FAIL = object()
-ERROR = object()
+# Potential outcomes. These are strings, rather than sentinel objects, so that
+# they survive the trip back from a worker process.
+
+PENDING = 'pending'
+OK = 'ok'
+FAIL = 'fail'
+ERROR = 'error'
 
 class Testcase:
     """
     A single pair of input and expected output directories.
     """
 
-    def __init__(self, root):
+    def __init__(self, root, environment=None, stream_format=None):
         self.root = root
+        self.environment = environment or {}
+        self.stream_format = stream_format
 
         self.src_root = path.join(root, 'src')
         self.expected_root = path.join(root, 'dest')
@@ -42,28 +63,54 @@ class Testcase:
         self.actual_root = path.join(scratch_dir, 'preparer-test-{}'.format(self.name()))
         self.actual_envelope_root = path.join(self.actual_root, 'envelopes')
         self.actual_asset_root = path.join(self.actual_root, 'assets')
+        self.actual_manifest = path.join(self.actual_root, 'manifest.json')
+        self.actual_stream = path.join(self.actual_root, 'stream')
 
         self.outcome = PENDING
         self.stacktrace = ''
         self.envelope_diff = None
         self.asset_diff = None
+        self.manifest_diff = None
+        self.serializer_diff = None
+        self.reproduction_diff = None
+        self.rebuild_diff = None
         self.output = ''
+        self.duration = 0.0
 
     def name(self):
         return path.basename(self.root)
 
-    def run(self):
+    def run(self, service=None):
         os.environ['CONTENT_ROOT'] = self.src_root
         os.environ['ENVELOPE_DIR'] = self.actual_envelope_root
         os.environ['ASSET_DIR'] = self.actual_asset_root
+        os.environ['MANIFEST_PATH'] = self.actual_manifest
+        os.environ.update(self.environment)
+        os.environ.update(self.stream_environment())
 
         rmtree(self.actual_root, ignore_errors=True)
 
+        started = time.perf_counter()
         capture = io.StringIO()
         with redirect_stderr(capture):
             with redirect_stdout(capture):
                 try:
-                    deconstrst.main()
+                    if service:
+                        self.build_with_service(service)
+                    else:
+                        deconstrst.main()
+
+                    if self.stream_format:
+                        self.unpack_stream()
+
+                    # Builds beyond the first are only compared when they write
+                    # individual files.
+                    if service or self.stream_format:
+                        self.reproduction_diff = []
+                        self.rebuild_diff = []
+                    else:
+                        self.reproduction_diff = self.check_reproduction()
+                        self.rebuild_diff = self.check_rebuilds()
                     if self.compare():
                         self.outcome = OK
                         rmtree(self.actual_root)
@@ -73,6 +120,73 @@ class Testcase:
                     self.outcome = ERROR
                     self.stacktrace = traceback.format_exc()
         self.output = capture.getvalue()
+        self.duration = time.perf_counter() - started
+
+    def build_with_service(self, service):
+        """
+        Ask the preparer service at "service" to build this testcase.
+        """
+
+        environment = dict(self.environment, MANIFEST_PATH=self.actual_manifest)
+        environment.update(self.stream_environment())
+        response = Client(service).build(self.src_root, self.actual_envelope_root,
+                                          self.actual_asset_root, environment=environment)
+        sys.stdout.write(response['output'])
+        if response['status'] != 0:
+            raise RuntimeError('The service exited with status {}.'.format(response['status']))
+
+    def stream_environment(self):
+        """
+        Settings that stream this testcase's envelopes and assets, if a stream
+        format was chosen.
+        """
+
+        if not self.stream_format:
+            return {}
+
+        return {
+            'OUTPUT_STREAM': self.actual_stream,
+            'OUTPUT_FORMAT': self.stream_format,
+            'OUTPUT_ASSETS': 'true',
+        }
+
+    def unpack_stream(self):
+        """
+        Write each envelope and asset found in the output stream to the
+        directories that it took the place of, so that they can be compared
+        with the expected output like any other build.
+        """
+
+        os.makedirs(self.actual_envelope_root, exist_ok=True)
+        os.makedirs(self.actual_asset_root, exist_ok=True)
+
+        if self.stream_format == 'tar':
+            with tarfile.open(self.actual_stream, 'r') as tar:
+                for member in tar.getmembers():
+                    if not member.isfile():
+                        continue
+                    top, relpath = member.name.split('/', 1)
+                    root = self.actual_envelope_root if top == 'envelopes' else self.actual_asset_root
+                    self.unpack_file(root, relpath, tar.extractfile(member).read())
+            return
+
+        with open(self.actual_stream, 'rb') as sf:
+            for line in sf:
+                record = json.loads(line.decode('utf-8'))
+                if 'envelope' in record:
+                    # Keep the envelope's exact bytes for the serializer check.
+                    prefix = '{{"contentID": {}, "envelope": '.format(json.dumps(record['contentID']))
+                    filename = urllib.parse.quote(record['contentID'], safe='') + '.json'
+                    self.unpack_file(self.actual_envelope_root, filename, line[len(prefix):-2])
+                elif 'asset' in record:
+                    self.unpack_file(self.actual_asset_root, record['asset'],
+                                     base64.b64decode(record['content']))
+
+    def unpack_file(self, root, relpath, content):
+        fullpath = path.join(root, relpath)
+        os.makedirs(path.dirname(fullpath), exist_ok=True)
+        with open(fullpath, 'wb') as f:
+            f.write(content)
 
     def compare(self):
         expected_envelopes = self.envelope_set_from(self.expected_envelope_root)
@@ -81,10 +195,179 @@ class Testcase:
         actual_envelopes = self.envelope_set_from(self.actual_envelope_root)
         actual_assets = self.asset_set_from(self.actual_asset_root)
 
-        self.envelope_diff = diff(actual_envelopes, expected_envelopes)
+        self.envelope_diff = diff_documents(actual_envelopes, expected_envelopes)
         self.asset_diff = diff(actual_assets, expected_assets)
-
-        return not self.envelope_diff and not self.asset_diff
+        self.manifest_diff = self.check_manifest()
+        self.serializer_diff = self.check_serializers()
+
+        return (not self.envelope_diff and not self.asset_diff and not self.manifest_diff
+                and not self.serializer_diff and not self.reproduction_diff
+                and not self.rebuild_diff)
+
+    def check_manifest(self):
+        """
+        Verify that the build manifest describes exactly the envelopes and
+        assets that were produced.
+        """
+
+        with open(self.actual_manifest, 'r') as mf:
+            manifest = json.load(mf)
+
+        listed_envelopes = {}
+        for content_id, e in manifest['envelopes'].items():
+            listed_envelopes[e['path']] = e
+        listed_assets = manifest['assets']
+
+        actual_envelopes = {}
+        for filename in os.listdir(self.actual_envelope_root):
+            actual_envelopes[filename] = self.file_summary(path.join(self.actual_envelope_root, filename))
+        actual_assets = {}
+        for relpath in self.asset_set_from(self.actual_asset_root):
+            actual_assets[relpath] = self.file_summary(path.join(self.actual_asset_root, relpath))
+
+        listed = {
+            'envelopes': {p: {'sha256': e['sha256'], 'size': e['size']} for p, e in listed_envelopes.items()},
+            'assets': {p: {'sha256': a['sha256'], 'size': a['size']} for p, a in listed_assets.items()},
+        }
+        actual = {'envelopes': actual_envelopes, 'assets': actual_assets}
+
+        return diff(listed, actual, ['manifest'])
+
+    def check_serializers(self):
+        """
+        Verify that every JSON serializer encodes each envelope to exactly the
+        bytes that were written. Every serializer must be available, so that
+        none of them go untested.
+        """
+
+        diffs = []
+        serializers = available_serializers()
+        unavailable = sorted(SERIALIZERS.keys() - {serializer.name for serializer in serializers})
+        if unavailable:
+            diffs.append(colored('! {} unavailable. Install test-requirements.txt.'
+                                 .format(', '.join(unavailable)), 'yellow'))
+
+        for filename in sorted(os.listdir(self.actual_envelope_root)):
+            with open(path.join(self.actual_envelope_root, filename), 'rb') as ef:
+                content = ef.read()
+            payload = json.loads(content.decode('utf-8'))
+
+            for serializer in serializers:
+                if serializer.dumps(payload) != content:
+                    diffs.append(colored('! {} encodes {} differently'.format(serializer.name, filename), 'yellow'))
+        return diffs
+
+    def check_reproduction(self):
+        """
+        Build the testcase again in a separate process with a different hash
+        seed, and verify that it writes exactly the same envelope bytes.
+        """
+
+        reproduction_root = path.join(self.actual_root, 'reproduction')
+        envelope_root = path.join(reproduction_root, 'envelopes')
+
+        hash_seed = '2' if os.environ.get('PYTHONHASHSEED') == '1' else '1'
+        env = dict(os.environ,
+                   CONTENT_ROOT=self.src_root,
+                   ENVELOPE_DIR=envelope_root,
+                   ASSET_DIR=path.join(reproduction_root, 'assets'),
+                   MANIFEST_PATH=path.join(reproduction_root, 'manifest.json'),
+                   PYTHONHASHSEED=hash_seed)
+        result = subprocess.run([sys.executable, '-m', 'deconstrst'], cwd=path.join(TESTCASE_ROOT, '..'),
+                                env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        sys.stdout.write(result.stdout.decode('utf-8', 'replace'))
+        if result.returncode != 0:
+            return [colored('! the build with PYTHONHASHSEED={} exited with status {}'
+                            .format(hash_seed, result.returncode), 'yellow')]
+
+        diffs = []
+        for filename in sorted(set(os.listdir(self.actual_envelope_root)) | set(os.listdir(envelope_root))):
+            actual, reproduced = None, None
+            if path.exists(path.join(self.actual_envelope_root, filename)):
+                actual = self.file_summary(path.join(self.actual_envelope_root, filename))
+            if path.exists(path.join(envelope_root, filename)):
+                reproduced = self.file_summary(path.join(envelope_root, filename))
+            if actual != reproduced:
+                diffs.append(colored('! the build with PYTHONHASHSEED={} wrote {} differently'
+                                     .format(hash_seed, filename), 'yellow'))
+        return diffs
+
+    def check_rebuilds(self):
+        """
+        Build a copy of a testcase that uses the serial builder in full, then
+        incrementally with nothing changed, after a document is touched and
+        after it's deleted. Verify how many envelopes each build writes, leaves
+        unchanged and removes.
+        """
+
+        if get_conf_builder(self.src_root) != 'deconst-serial':
+            return []
+
+        # Extensions installed from a testcase's requirements may depend on
+        # where it lives. reno, for one, reads release notes from git history.
+        if path.exists(path.join(self.src_root, 'requirements.txt')):
+            return []
+
+        rebuild_root = path.join(self.actual_root, 'rebuild')
+        content_root = path.join(rebuild_root, 'src')
+        envelope_root = path.join(rebuild_root, 'envelopes')
+        copytree(self.src_root, content_root, ignore=ignore_patterns('_build'))
+
+        os.environ['CONTENT_ROOT'] = content_root
+        os.environ['ENVELOPE_DIR'] = envelope_root
+        os.environ['ASSET_DIR'] = path.join(rebuild_root, 'assets')
+        os.environ['MANIFEST_PATH'] = path.join(rebuild_root, 'manifest.json')
+
+        def build(incremental=True):
+            os.environ['INCREMENTAL_BUILD'] = 'true' if incremental else 'false'
+            capture = io.StringIO()
+            with redirect_stdout(capture):
+                deconstrst.main()
+            sys.stdout.write(capture.getvalue())
+            return [int(c) for c in ENVELOPE_SUMMARY.findall(capture.getvalue())[-1]]
+
+        diffs = []
+        expected_builds = [
+            ('a full build', False, [len(os.listdir(self.expected_envelope_root)), 0, 0]),
+            ('an incremental build with nothing changed', True, [0, 0, 0]),
+        ]
+        for description, incremental, expected in expected_builds:
+            counts = build(incremental)
+            if counts != expected:
+                diffs.append(colored('! {} wrote, left unchanged and removed {} envelopes instead of {}'
+                                     .format(description, counts, expected), 'yellow'))
+
+        documents = sorted(f for f in os.listdir(content_root)
+                           if f.endswith('.rst') and f not in ('index.rst', '_toc.rst'))
+        if documents:
+            # A document that's saved without changes is written again, but
+            # its envelope is left untouched, and it isn't outdated afterward.
+            os.utime(path.join(content_root, documents[0]))
+            written, unchanged, removed = build()
+            if written != 0 or unchanged == 0 or removed != 0:
+                diffs.append(colored('! touching {} wrote, left unchanged and removed {} envelopes'
+                                     .format(documents[0], [written, unchanged, removed]), 'yellow'))
+
+            counts = build()
+            if counts != [0, 0, 0]:
+                diffs.append(colored('! the build after touching {} wrote, left unchanged and removed {} envelopes'
+                                     .format(documents[0], counts), 'yellow'))
+
+            before = set(os.listdir(envelope_root))
+            os.remove(path.join(content_root, documents[0]))
+
+            removed = build()[2]
+            gone = before - set(os.listdir(envelope_root))
+            if removed != 1 or len(gone) != 1:
+                diffs.append(colored('! deleting {} removed {} envelopes instead of 1'
+                                     .format(documents[0], removed), 'yellow'))
+
+        return diffs
+
+    def file_summary(self, fullpath):
+        with open(fullpath, 'rb') as f:
+            content = f.read()
+        return {'sha256': hashlib.sha256(content).hexdigest(), 'size': len(content)}
 
     def envelope_set_from(self, root):
         envelopes = {}
@@ -106,15 +389,15 @@ class Testcase:
                     fullpath = path.join(dirpath, filename)
                     relpath = path.relpath(fullpath, root)
                     assets.append(relpath)
-        return assets
+        return sorted(assets)
 
     def report(self):
         report = io.StringIO()
         header, output, diff, stacktrace = False, False, False, False
 
-        if self.outcome is FAIL:
+        if self.outcome == FAIL:
             header, output, diff = True, True, True
-        elif self.outcome is ERROR:
+        elif self.outcome == ERROR:
             header, output, stacktrace = True, True, True
 
         if header:
@@ -136,6 +419,22 @@ class Testcase:
             for diff in self.asset_diff:
                 report.write(diff)
                 report.write('\n')
+            report.write(colored('\n\nmanifest\n', 'yellow'))
+            for diff in self.manifest_diff:
+                report.write(diff)
+                report.write('\n')
+            report.write(colored('\n\nserializers\n', 'yellow'))
+            for diff in self.serializer_diff:
+                report.write(diff)
+                report.write('\n')
+            report.write(colored('\n\nreproduction\n', 'yellow'))
+            for diff in self.reproduction_diff:
+                report.write(diff)
+                report.write('\n')
+            report.write(colored('\n\nrebuilds\n', 'yellow'))
+            for diff in self.rebuild_diff:
+                report.write(diff)
+                report.write('\n')
 
         if stacktrace:
             report.write(colored('>> stacktrace\n', 'cyan'))
@@ -144,31 +443,126 @@ class Testcase:
         return report.getvalue()
 
 
-testcases = []
-for entry in os.scandir(TESTCASE_ROOT):
-    if entry.is_dir() and not entry.name.startswith('_'):
-        testcases.append(Testcase(entry.path))
+def run_testcase(testcase, service=None):
+    """
+    Run a single testcase within a pool worker and send it back, outcome and
+    all.
+    """
+
+    # Pool workers are daemonic, and daemonic processes may not start children
+    # of their own, as Sphinx does when PARALLEL_WORKERS is set.
+    multiprocessing.current_process().daemon = False
+
+    testcase.run(service)
+    return testcase
+
+
+@contextmanager
+def preparer_service():
+    """
+    Run a preparer service on a Unix socket for as long as the context lasts.
+    Yield its address.
+    """
+
+    scratch = tempfile.mkdtemp(prefix='preparer-service-')
+    address = 'unix:' + path.join(scratch, 'preparer.sock')
+    log_path = path.join(scratch, 'service.log')
+
+    with open(log_path, 'wb') as log:
+        proc = subprocess.Popen([sys.executable, '-m', 'deconstrst', '--serve', address],
+                                cwd=path.join(TESTCASE_ROOT, '..'), stdout=log, stderr=log)
+    try:
+        client = Client(address)
+        deadline = time.time() + 30
+        while not client.health():
+            if proc.poll() is not None or time.time() > deadline:
+                with open(log_path, 'r', encoding='utf-8', errors='replace') as log:
+                    raise RuntimeError('The preparer service failed to start:\n' + log.read())
+            time.sleep(0.1)
+
+        yield address
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+            proc.wait()
+        rmtree(scratch, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the preparer against each testcase.')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes to run testcases in (default: one per CPU)')
+    parser.add_argument('--service', action='store_true',
+                        help='build each testcase by sending a request to a preparer service')
+    parser.add_argument('--parallel-workers', type=int, default=None,
+                        help='read and write the documents of each testcase in this many processes')
+    parser.add_argument('--stream', choices=['ndjson', 'tar'], default=None,
+                        help='write the envelopes and assets of each testcase into a stream of this format')
+    parser.add_argument('names', nargs='*', help='run only these testcases')
+    args = parser.parse_args()
+
+    environment = {}
+    if args.parallel_workers:
+        environment['PARALLEL_WORKERS'] = str(args.parallel_workers)
+
+    testcases = []
+    for entry in sorted(os.scandir(TESTCASE_ROOT), key=lambda e: e.name):
+        if entry.is_dir() and not entry.name.startswith('_'):
+            if not args.names or entry.name in args.names:
+                testcases.append(Testcase(entry.path, environment, args.stream))
+
+    s = 's'
+    if len(testcases) == 1:
+        s = ''
+    summary = '{} testcase{} discovered.'.format(len(testcases), s)
+    cprint(summary, attrs=['bold'])
+
+    workers = args.workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(testcases)))
+
+    # Each testcase runs in a fresh process, so that its changes to the
+    # environment, the working directory and Sphinx's global state can't
+    # leak into the next one.
+    if args.service:
+        with preparer_service() as service:
+            results = run_testcases(testcases, workers, service)
+    else:
+        results = run_testcases(testcases, workers)
+
+    r = '\n'.join(t.report() for t in results)
+    print(r)
+
+    if any(t.outcome != OK for t in results):
+        sys.exit(1)
+
+
+def run_testcases(testcases, workers, service=None):
+    """
+    Run testcases in a pool of worker processes, reporting each outcome as it
+    arrives. Return the testcases that were run.
+    """
 
-s = 's'
-if len(testcases) == 1:
-    s = ''
-summary = '{} testcase{} discovered.'.format(len(testcases), s)
-cprint(summary, attrs=['bold'])
+    pool = multiprocessing.Pool(workers, maxtasksperchild=1)
+    try:
+        results = []
+        for testcase in pool.imap(functools.partial(run_testcase, service=service), testcases):
+            cprint('{} .. '.format(testcase.name()), 'cyan', end='')
 
-for testcase in testcases:
-    cprint('{} .. '.format(testcase.name()), 'cyan', end='')
+            if testcase.outcome == OK:
+                cprint('ok', 'green', end='')
+            elif testcase.outcome == FAIL:
+                cprint('fail', 'red', end='')
+            elif testcase.outcome == ERROR:
+                cprint('error', 'red', end='')
+            print(' ({:.2f}s)'.format(testcase.duration))
 
-    testcase.run()
+            results.append(testcase)
+    finally:
+        pool.close()
+        pool.join()
 
-    if testcase.outcome is OK:
-        cprint('ok', 'green')
-    elif testcase.outcome is FAIL:
-        cprint('fail', 'red')
-    elif testcase.outcome is ERROR:
-        cprint('error', 'red')
+    return results
 
-r = '\n'.join(t.report() for t in testcases)
-print(r)
 
-if any(t.outcome is not OK for t in testcases):
-    sys.exit(1)
+if __name__ == '__main__':
+    main()
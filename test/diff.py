@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import difflib
+import hashlib
 import json
 from termcolor import colored
 
@@ -19,6 +21,35 @@ def diff(actual, expected, keypath=[], indent=''):
     else:
         return [_unequal(keypath, actual, expected, indent)]
 
+def diff_documents(actual, expected, keypath=[], indent=''):
+    """
+    Diff two maps of names to parsed JSON documents, such as envelopes. Each
+    document is reduced to a digest first, so that only those that differ are
+    compared in detail.
+    """
+
+    diffs = []
+    for missing in sorted(expected.keys() - actual.keys()):
+        diffs.append(_missing(keypath + [missing], expected[missing], indent))
+
+    for extra in sorted(actual.keys() - expected.keys()):
+        diffs.append(_extra(keypath + [extra], actual[extra], indent))
+
+    for shared in sorted(expected.keys() & actual.keys()):
+        if digest(actual[shared]) != digest(expected[shared]):
+            diffs += diff(actual[shared], expected[shared], keypath + [shared], indent)
+
+    return diffs
+
+def digest(item):
+    """
+    Summarize a parsed JSON document as a digest that doesn't depend on the
+    order of its keys.
+    """
+
+    canonical = json.dumps(item, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
 def _diff_dicts(actual, expected, keypath=[], indent=''):
     actual_keys = actual.keys()
     expected_keys = expected.keys()
@@ -37,18 +68,34 @@ def _diff_dicts(actual, expected, keypath=[], indent=''):
     return diffs
 
 def _diff_lists(actual, expected, keypath=[], indent=''):
-    actual_set = set(actual)
-    expected_set = set(expected)
+    # Match items by their canonical form, which works for dicts and lists too.
+    actual_keys = [_canonical(item) for item in actual]
+    expected_keys = [_canonical(item) for item in expected]
+    matcher = difflib.SequenceMatcher(None, expected_keys, actual_keys, autojunk=False)
 
     diffs = []
-    for missing in expected_set - actual_set:
-        diffs.append(colored('- {}'.format(missing), 'red'))
+    for op, e_start, e_end, a_start, a_end in matcher.get_opcodes():
+        if op == 'equal':
+            continue
 
-    for extra in actual_set - expected_set:
-        diffs.append(colored('+ {}'.format(extra), 'green'))
+        if op == 'replace' and e_end - e_start == a_end - a_start:
+            # Items were changed in place: show how.
+            for offset in range(e_end - e_start):
+                diffs += diff(actual[a_start + offset], expected[e_start + offset],
+                              keypath + [str(a_start + offset)], indent)
+            continue
+
+        for index in range(e_start, e_end):
+            diffs.append(_missing(keypath + [str(index)], expected[index], indent))
+
+        for index in range(a_start, a_end):
+            diffs.append(_extra(keypath + [str(index)], actual[index], indent))
 
     return diffs
 
+def _canonical(item):
+    return json.dumps(item, sort_keys=True, separators=(',', ':'))
+
 def _missing(keypath, missing, indent=''):
     hline = _hline('-', keypath, 'red')
     return hline + _body(missing, indent)